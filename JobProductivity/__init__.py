@@ -1,83 +1,167 @@
+import contextvars
 import datetime
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Tuple
 
 import azure.functions as func
-from utils import sql, nulogy as nu
+import pandas as pd
+from utils import config, metrics, sql, schema, nulogy as nu
 
+TABLE = 'PRODUCTION_RECORDS'
 
-def main(mytimer: func.TimerRequest) -> None:
-    utc_timestamp = datetime.datetime.utcnow().replace(
-        tzinfo=datetime.timezone.utc).isoformat()
-
-    if mytimer.past_due:
-        logging.info('The timer is past due!')
+# Job start dates more than this many days apart are requested from job_productivity separately,
+# so one old uninvoiced job doesn't stretch the report over months of jobs that aren't needed.
+JOB_CLUSTER_GAP_DAYS = int(os.environ.get('JOB_CLUSTER_GAP_DAYS', 7))
 
 
-    # Run job profitability report to get all jobs that have not been invoiced. Include [Actual Start Date]
+def job_start_dates(filters: List[dict]) -> Dict[str, datetime.date]:
+    """
+    Start date of every job in the job profitability report matching the filters, by job ID.
+    """
     report_code = "job_profitability"
     columns = ["actual_job_start_at"]
-    filters = [{"column": "invoiced", "operator": "=", "threshold": "false"}]
-
-    report = nu.get_report(report_code, columns, filters, headers=False)
-
-    jobs_not_invoiced = {}
-    for line in report:
-        if not line[1]:
-            continue
-
-        jobs_not_invoiced[line[0]] = datetime.datetime.strptime(line[1], "%Y-%b-%d %I:%M %p").date()
-
-    # Get jobs that were invoiced yesterday.
-    report_code = "job_profitability"
-    columns = ["invoiced"]
-    filters = [{"column": "invoiced", "operator": "=", "threshold": "true"}, {"column": "invoiced_at", "operator": "=", "threshold": "yesterday"}]
-
-    report = nu.get_report(report_code, columns, filters, headers=False)
-    jobs_invoiced_yesterday = [job_id for job_id, _ in report]
-
-
-    # Run job productivity report filtered to min/max start date from job profitability report.
-
-    earliest_job = min(jobs_not_invoiced.values()).strftime('%Y-%b-%d 00:00 AM')
-    latest_job = max(jobs_not_invoiced.values()).strftime('%Y-%b-%d 11:59 PM')
 
+    report = nu.get_report(report_code, columns, filters)
+    jobs = schema.parse_report(report_code, columns, report, rename=True).dropna(subset=["actual_job_start_at"])
+
+    return dict(zip(jobs.iloc[:, 0], jobs["actual_job_start_at"].dt.date))
+
+def cluster_dates(dates: Iterable[datetime.date], gap_days: int=JOB_CLUSTER_GAP_DAYS) -> List[Tuple[datetime.date, datetime.date]]:
+    """
+    Group dates into (earliest, latest) ranges, starting a new range wherever there is a gap of more than gap_days.
+    """
+    clusters = []
+    for date in sorted(set(dates)):
+        if clusters and (date - clusters[-1][1]).days <= gap_days:
+            clusters[-1] = (clusters[-1][0], date)
+        else:
+            clusters.append((date, date))
+    return clusters
+
+def get_job_productivity(clusters: List[Tuple[datetime.date, datetime.date]]) -> pd.DataFrame:
+    """
+    Run the job productivity report for each range of start dates at the same time and combine them.
+    """
     report_code = "job_productivity"
     columns = ["line_name", "line_leader_name", "actual_job_end_at", "project_customer", "item_code", "units_expected", "units_produced", "pallets_produced", "standard_people", "number_of_personnel", "actual_person_hours", "line_efficiency"]
-    filters = [{"column": "actual_job_start_at", "operator": "between", "from_threshold": earliest_job, "to_threshold": latest_job }]
     sort_by = [{"column": "line_name", "direction": 'asc'}]
 
+    def run(cluster: Tuple[datetime.date, datetime.date]) -> pd.DataFrame:
+        earliest_job, latest_job = cluster
+        filters = [{"column": "actual_job_start_at", "operator": "between", "from_threshold": earliest_job.strftime('%Y-%b-%d 00:00 AM'),
+                                                                            "to_threshold": latest_job.strftime('%Y-%b-%d 11:59 PM')}]
+        report = nu.get_report(report_code=report_code, columns=columns, filters=filters, sort_by=sort_by)
+        return schema.parse_report(report_code, columns, report, rename=True)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(len(clusters), nu.MAX_CONCURRENT_REPORTS))) as executor:
+        frames = list(executor.map(lambda cluster: contextvars.copy_context().run(run, cluster), clusters))
+
+    report = pd.concat(frames, ignore_index=True)
+    return report.rename(columns={report.columns[0]: "Job ID"})
+
+def existing_records(job_ids: List[str], columns: List[str], batch_size: int=1000) -> pd.DataFrame:
+    """
+    The rows of PRODUCTION_RECORDS for the given jobs.
+    """
+    frames = []
+    for start in range(0, len(job_ids), batch_size):
+        ids = ', '.join("'" + job_id.replace("'", "''") + "'" for job_id in job_ids[start:start + batch_size])
+        query = f"SELECT {', '.join(f'[{column}]' for column in columns)} FROM {TABLE} WHERE [Job ID] IN ({ids})"
+        frames.append(pd.read_sql(query, sql.engine))
+
+    existing = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+    existing["Job ID"] = existing["Job ID"].astype(str)
+    return existing.drop_duplicates(subset=["Job ID"], keep="last").set_index("Job ID")
+
+def _comparable(df: pd.DataFrame, like: pd.DataFrame) -> pd.DataFrame:
+    """
+    Values of df converted to the types of like's columns, so rows read back from SQL compare equal to
+    freshly built rows with the same values (numbers to 6 decimals, times to the minute).
+    """
+    converted = {}
+    for column in like.columns:
+        values, dtype = df[column], like[column].dtype
+        if pd.api.types.is_bool_dtype(dtype):
+            converted[column] = values.astype(str).str.strip().str.lower().isin(['1', 'true'])
+        elif pd.api.types.is_numeric_dtype(dtype):
+            converted[column] = pd.to_numeric(values, errors='coerce').round(6)
+        elif pd.api.types.is_datetime64_any_dtype(dtype):
+            converted[column] = pd.to_datetime(values, errors='coerce').dt.floor('min')
+        else:
+            converted[column] = values.astype(object).map(lambda value: None if pd.isna(value) else str(value).strip())
+    return pd.DataFrame(converted, index=df.index)
+
+def changed_records(records: pd.DataFrame, existing: pd.DataFrame) -> pd.DataFrame:
+    """
+    The records (indexed by job ID) that are not in existing yet or differ from the stored row.
+    """
+    known = records.index.isin(existing.index)
+    changed = ~known
+
+    if known.any():
+        current = pd.util.hash_pandas_object(_comparable(records[known], records), index=False).to_numpy()
+        stored = pd.util.hash_pandas_object(_comparable(existing.loc[records.index[known]], records), index=False).to_numpy()
+        changed[known] = current != stored
+
+    return records[changed]
+
+@metrics.timed('JobProductivity')
+def main(mytimer: func.TimerRequest) -> None:
+    utc_timestamp = datetime.datetime.utcnow().replace(
+        tzinfo=datetime.timezone.utc).isoformat()
+
+    if mytimer.past_due:
+        logging.info('The timer is past due!')
 
-    report = nu.get_report(report_code=report_code, columns=columns, filters=filters, sort_by=sort_by, headers=False)
-
-    production_records = {}
-    for line in report:
-        production_records[line[0]] = {
-            "Job ID"                : line[0],
-            "Line Name"             : line[1],
-            "Line Leader"           : line[2],
-            "Actual Job End Date"   : line[3],
-            "Work Order Customer"   : line[4],
-            "Item Code"             : line[5],
-            "Units Expected"        : float(line[6]),
-            "Units Produced"        : float(line[7]),
-            "Pallets Produced"      : float(line[8]),
-            "Standard People"       : float(line[9]),
-            "Actual People"         : float(line[10]),
-            "Actual Hours"          : float(line[11]),
-            "Line Efficiency"       : float(line[12].replace('%', ''))/100,
-            "Invoiced"              : False
-        }
-
-    # Update production records with invoiced jobs.
-    for job_id in jobs_invoiced_yesterday:
-        production_records[job_id]["Invoiced"] = True
-
-    # Match jobs from job productivity report to jobs from job profitability report.
-    production_records = {k:v for k,v in production_records.items() if k in jobs_not_invoiced or v["Invoiced"]}
-
-    # Check database for job ids that are in dataset.
-    for job_id, details in production_records.items():
-
-        sql.insert_or_update(table='PRODUCTION_RECORDS', key=['Job ID'], record=details)
+    config.get_secrets('NULOGY_SECRET_KEY', 'AZURE_DB_CONNECTION_STRING')
+
+    # Jobs that have not been invoiced, and jobs that were invoiced yesterday, with their start dates.
+    jobs_not_invoiced = job_start_dates([{"column": "invoiced", "operator": "=", "threshold": "false"}])
+    jobs_invoiced_yesterday = job_start_dates([{"column": "invoiced", "operator": "=", "threshold": "true"},
+                                               {"column": "invoiced_at", "operator": "=", "threshold": "yesterday"}])
+
+    jobs = {**jobs_not_invoiced, **jobs_invoiced_yesterday}
+    if not jobs:
+        logging.info('No jobs to update')
+        return
+
+    # Run job productivity report over clusters of the jobs' start dates rather than one min/max span.
+    clusters = cluster_dates(jobs.values())
+    logging.info(f"Requesting job productivity for {len(jobs)} jobs in {len(clusters)} date ranges")
+    report = get_job_productivity(clusters)
+
+    production_records = pd.DataFrame({
+        "Job ID"                : report["Job ID"].astype(str),
+        "Line Name"             : report["line_name"],
+        "Line Leader"           : report["line_leader_name"],
+        "Actual Job End Date"   : report["actual_job_end_at"],
+        "Work Order Customer"   : report["project_customer"],
+        "Item Code"             : report["item_code"],
+        "Units Expected"        : report["units_expected"],
+        "Units Produced"        : report["units_produced"],
+        "Pallets Produced"      : report["pallets_produced"],
+        "Standard People"       : report["standard_people"],
+        "Actual People"         : report["number_of_personnel"],
+        "Actual Hours"          : report["actual_person_hours"],
+        "Line Efficiency"       : report["line_efficiency"] / 100,
+        "Invoiced"              : False
+    }).drop_duplicates(subset=["Job ID"], keep="last")
+
+    # Mark the jobs invoiced yesterday and keep only the jobs we need.
+    production_records.loc[production_records["Job ID"].isin(list(jobs_invoiced_yesterday)), "Invoiced"] = True
+    production_records = production_records[production_records["Job ID"].isin(list(jobs))].set_index("Job ID")
+
+    # Compare with what is already stored and write only new and changed jobs, in one batch.
+    existing = existing_records(list(production_records.index), ["Job ID", *production_records.columns])
+    changed = changed_records(production_records, existing)
+    logging.info(f"{len(changed)} of {len(production_records)} jobs are new or changed")
+
+    if not changed.empty:
+        changed = changed.reset_index()
+        changed = changed.astype(object).where(changed.notna(), None)
+        sql.bulk_upsert(table=TABLE, key=['Job ID'], columns=list(changed.columns),
+                        rows=changed.itertuples(index=False, name=None))
 
     logging.info('Python timer trigger function ran at %s', utc_timestamp)
@@ -1,19 +1,58 @@
 import datetime
+import json
 import logging
+import os
 import pytz
 import asyncio
-from utils import nulogy, sql
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, NamedTuple
+from utils import config, metrics, nulogy, pipeline, sql, sync
 import azure.functions as func
+import numpy as np
 import pandas as pd
 
+# Maximum number of report pipelines that run at the same time. Each pipeline spends most
+# of its time waiting on Nulogy, so they are run on worker threads rather than one by one.
+MAX_CONCURRENT_JOBS = int(os.environ.get('NIGHTLY_MAX_CONCURRENT_JOBS', 9))
+
+# Date ranges the large reports are split into on a full sync, so Nulogy builds them in parallel.
+REPORT_SHARDS = int(os.environ.get('NIGHTLY_REPORT_SHARDS', 4))
+
+# Location prefix -> warehouse for the inventory summary. The longest matching prefix wins and locations
+# that match none are 'Other'. Set the WAREHOUSE_RULES app setting to a JSON object of the same shape to
+# add or change warehouses without a deploy.
+WAREHOUSE_RULES = json.loads(os.environ.get('WAREHOUSE_RULES') or 'null') or {
+    'B'             : 'Burnett',
+    'L'             : 'Locust',
+    'D'             : 'Dixie',
+    'Line'          : 'Dixie',
+    'LW'            : 'Locust West',
+    'LOCUST WEST'   : 'Locust West',
+}
 
 def timestamp() -> str:
     return datetime.datetime.now(pytz.timezone('US/Eastern')).strftime('%Y-%m-%d %H:%M')
 
-async def process_ship_orders (days: int=28) -> None:
+def sync_window(table: str, timestamp: datetime.datetime, days: int, whole_days: bool=True) -> sync.SyncWindow:
+    """
+    Window of records to reload into the table: the last `days` days on a full sync, or, for the tables
+    in sync.INCREMENTAL_TABLES, only rows dated since the last successful sync otherwise. whole_days
+    widens the full window to midnight.
+    """
+    from_threshold = timestamp - datetime.timedelta(days=days)
+    to_threshold = timestamp
+    if whole_days:
+        from_threshold = from_threshold.replace(hour=0, minute=0)
+        to_threshold = to_threshold.replace(hour=23, minute=59)
+
+    return sync.get_sync_window(table, from_threshold, to_threshold, started_at=timestamp)
+
+def process_ship_orders (days: int=28) -> None:
     timestamp = datetime.datetime.now(pytz.timezone('US/Eastern'))
-    from_threshold = (timestamp - datetime.timedelta(days=days)).strftime("%Y-%m-%d 00:00")
-    to_threshold = timestamp.strftime("%Y-%m-%d 23:59")
+    window = sync_window('factShipOrder', timestamp, days)
+    from_threshold = window.from_threshold.strftime("%Y-%m-%d %H:%M")
+    to_threshold = window.to_threshold.strftime("%Y-%m-%d %H:%M")
 
     report_code = 'ship_order'
     columns = ['actual_unit_quantity', 'added_unit_quantity', 'carrier', 'carrier_code', 'carrier_type', 
@@ -25,21 +64,19 @@ async def process_ship_orders (days: int=28) -> None:
                'site_name', 'unit_of_measure']
     filters = [{'column': 'ship_order_created_at', 'operator': 'between', 'from_threshold': from_threshold, 'to_threshold': to_threshold}]
 
-    report = nulogy.get_report(report_code=report_code, columns=columns, filters=filters)
-
-    # remove old records
-    sql.execute(f"DELETE FROM factShipOrder WHERE [Ship Order created at] BETWEEN '{from_threshold}' AND '{to_threshold}'")
+    report = nulogy.get_report(report_code=report_code, columns=columns, filters=filters, stream=True)
 
     headers = next(report)
-    for row in report:
-        row = {k: v for k, v in zip(headers, row)}
-        sql.insert(table='factShipOrder', record=row)
+    where = f"[Ship Order created at] BETWEEN '{from_threshold}' AND '{to_threshold}'"
+    pipeline.run(report, pipeline.replace_sink('factShipOrder', headers, where), name='factShipOrder')
+    sync.mark_synced('factShipOrder', window)
 
-async def process_shipments (days: int=28) -> None:
+def process_shipments (days: int=28) -> None:
 
     timestamp = datetime.datetime.now(pytz.timezone('US/Eastern'))
-    from_threshold = (timestamp - datetime.timedelta(days=days)).strftime("%Y-%m-%d 00:00")
-    to_threshold = timestamp.strftime("%Y-%m-%d 23:59")
+    window = sync_window('factShipment', timestamp, days)
+    from_threshold = window.from_threshold.strftime("%Y-%m-%d %H:%M")
+    to_threshold = window.to_threshold.strftime("%Y-%m-%d %H:%M")
 
     report_code = 'shipment_item'
     columns = ['actual_arrival_at', 'actual_delivery_at', 'actual_ship_at', 'base_quantity', 
@@ -61,21 +98,20 @@ async def process_shipments (days: int=28) -> None:
                'tracking_number', 'trailer_number']
     filters = [{'column': 'created_at', 'operator': 'between', 'from_threshold': from_threshold, 'to_threshold': to_threshold}]
                
-    report = nulogy.get_report(report_code=report_code, columns=columns, filters=filters)
-
-    # remove old records
-    sql.execute(f"DELETE FROM factShipment WHERE [Created At] BETWEEN '{from_threshold}' AND '{to_threshold}'")
+    report = nulogy.get_report(report_code=report_code, columns=columns, filters=filters, stream=True,
+                               shards=REPORT_SHARDS if window.full else 1)
 
     headers = next(report)
-    for row in report:
-        row = {k: v for k, v in zip(headers, row)}
-        sql.insert(table='factShipment', record=row)
+    where = f"[Created At] BETWEEN '{from_threshold}' AND '{to_threshold}'"
+    pipeline.run(report, pipeline.replace_sink('factShipment', headers, where), name='factShipment')
+    sync.mark_synced('factShipment', window)
 
-async def process_receipts (days: int=28) -> None:
+def process_receipts (days: int=28) -> None:
     
     timestamp = datetime.datetime.now(pytz.timezone('US/Eastern'))
-    from_threshold = (timestamp - datetime.timedelta(days=days)).strftime("%Y-%m-%d %H:%M")
-    to_threshold = timestamp.strftime("%Y-%m-%d %H:%M")
+    window = sync_window('factReceipt', timestamp, days, whole_days=False)
+    from_threshold = window.from_threshold.strftime("%Y-%m-%d %H:%M")
+    to_threshold = window.to_threshold.strftime("%Y-%m-%d %H:%M")
 
     report_code = 'receipt_item'
     columns = ['base_quantity', 'base_unit_of_measure', 'bill_of_lading', 'case_quantity', 'case_unit_of_measure', 
@@ -93,17 +129,45 @@ async def process_receipts (days: int=28) -> None:
     filters = [{'column': 'received_at', 'operator': 'between', 'from_threshold': from_threshold,
                                                                     'to_threshold': to_threshold}]
 
-    report = nulogy.get_report(report_code=report_code, columns=columns, filters=filters)
-
-    # remove old records
-    sql.execute(f"DELETE FROM factReceipt WHERE [Received at] BETWEEN '{from_threshold}' AND '{to_threshold}'")
+    report = nulogy.get_report(report_code=report_code, columns=columns, filters=filters, stream=True,
+                               shards=REPORT_SHARDS if window.full else 1)
 
     headers = next(report)
-    for row in report:
-        row = {k: v for k, v in zip(headers, row)}
-        sql.insert(table='factReceipt', record=row)
+    where = f"[Received at] BETWEEN '{from_threshold}' AND '{to_threshold}'"
+    pipeline.run(report, pipeline.replace_sink('factReceipt', headers, where), name='factReceipt')
+    sync.mark_synced('factReceipt', window)
+
+def row_hashes(df: pd.DataFrame) -> np.ndarray:
+    return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+class ExistingRows(NamedTuple):
+    hashes  : np.ndarray        # sorted, distinct uint64 row hashes
+    counts  : np.ndarray        # rows with each hash not matched yet
 
-async def process_moves (days: int=2) -> None:
+def existing_rows(existing_hashes: np.ndarray) -> ExistingRows:
+    hashes, counts = np.unique(existing_hashes, return_counts=True)
+    return ExistingRows(hashes, counts)
+
+def anti_join(df: pd.DataFrame, existing: ExistingRows) -> pd.DataFrame:
+    """
+    Rows of df whose hash is not in existing. Repeated rows are matched one for one, so a row that
+    appears twice in df but once in existing is kept once. Matched rows are taken off existing.counts,
+    so df can be passed in batches.
+    """
+    if len(existing.hashes) == 0:
+        return df
+
+    hashes = pd.Series(row_hashes(df))
+    occurrence = hashes.groupby(hashes).cumcount().to_numpy()
+
+    position = np.minimum(np.searchsorted(existing.hashes, hashes.to_numpy()), len(existing.hashes) - 1)
+    existing_count = np.where(existing.hashes[position] == hashes.to_numpy(), existing.counts[position], 0)
+
+    keep = occurrence >= existing_count
+    np.subtract.at(existing.counts, position[~keep], 1)
+    return df[keep]
+
+def process_moves (days: int=2) -> None:
     
     logging.info('==Processing moves')
 
@@ -112,15 +176,6 @@ async def process_moves (days: int=2) -> None:
     to_threshold = start_time.strftime("%Y-%m-%d %H:%M")
 
 
-    logging.info(f"Getting Azure data... {timestamp()}")
-    query = f"""
-    SELECT *
-    FROM factMove
-    WHERE [Time completed] BETWEEN '{from_threshold}' AND '{to_threshold}'"""
-
-    azure_df =  pd.read_sql(query, sql.engine)
-
-
     logging.info(f"Getting Nulogy data... {timestamp()}")
     report_code = 'move_transaction'
     columns = ['assigned_to', 'from_location', 'from_pallet_number', 'to_location', 'to_pallet_number', 'time_completed_at', 
@@ -128,26 +183,40 @@ async def process_moves (days: int=2) -> None:
     filters = [{'column': 'time_completed_at', 'operator': 'between', 'from_threshold': from_threshold,
                                                                       'to_threshold': to_threshold}]
     
+    # Not streamed: the download would sit open while the existing rows are read. Only the CSV text is
+    # held; rows are turned into DataFrames a batch at a time by the pipeline below.
     report = nulogy.get_report(report_code=report_code, columns=columns, filters=filters)
+    field_names = next(report)
 
 
-    logging.info(f"Getting new data... {timestamp()}")
-    field_names = next(report)
-    nulogy_df = pd.DataFrame.from_records(report, columns=field_names)
+    logging.info(f"Getting Azure data... {timestamp()}")
+    query = f"""
+    SELECT {', '.join(f"[{column}]" for column in field_names)}
+    FROM factMove
+    WHERE [Time completed] BETWEEN '{from_threshold}' AND '{to_threshold}'"""
 
-    # Converting nulogy_df dtypes to match azure_df
-    convert_dict = {column: dtype for column, dtype in zip(azure_df.columns, azure_df.dtypes)}
-    nulogy_df = nulogy_df.astype(convert_dict)
+    # Only a 64-bit hash of each existing row is kept (about 16 bytes a distinct row with its count), not the rows.
+    existing_hashes = []
+    convert_dict = None
+    for azure_df in pd.read_sql(query, sql.engine, chunksize=50_000):
+        if convert_dict is None:
+            # Converting nulogy dtypes to match azure_df
+            convert_dict = {column: dtype for column, dtype in zip(azure_df.columns, azure_df.dtypes)}
+        existing_hashes.append(row_hashes(azure_df.astype(convert_dict)))
+    existing = existing_rows(np.concatenate(existing_hashes) if existing_hashes else np.empty(0, dtype='uint64'))
 
-    # Get new unique records
-    unique_df = pd.concat([nulogy_df, azure_df]).drop_duplicates(keep=False)
 
-    logging.info(f"Writing {len(unique_df)} new records to Azure... {timestamp()}")
-    unique_df.to_sql('factMove', sql.engine, if_exists='append', index=False, chunksize=1000)
+    def to_frame(rows: List[list]) -> pd.DataFrame:
+        df = pd.DataFrame.from_records(rows, columns=field_names)
+        return df if convert_dict is None else df.astype(convert_dict)
 
-    logging.info(f"==Finished processing moves... {timestamp()}")
+    logging.info(f"Writing new records to Azure... {timestamp()}")
+    written = pipeline.run(report, pipeline.frame_sink('factMove'), stages=[to_frame, lambda df: anti_join(df, existing)],
+                           name='factMove')
 
-async def process_picks(days: int=7) -> None:
+    logging.info(f"==Finished processing moves, {written} new records... {timestamp()}")
+
+def process_picks(days: int=7) -> None:
 
     timestamp = datetime.datetime.now(pytz.timezone('US/Eastern'))
     report_code = 'picked_inventory'
@@ -159,20 +228,20 @@ async def process_picks(days: int=7) -> None:
     filters = [{'column': 'date_picked_at', 'operator': 'between', 'from_threshold': (timestamp - datetime.timedelta(days=days)).strftime("%Y-%m-%d %H:%M"),
                                                                       'to_threshold': timestamp.strftime("%Y-%m-%d %H:%M")}]
 
-    report = nulogy.get_report(report_code=report_code, columns=columns, filters=filters)
+    report = nulogy.get_report(report_code=report_code, columns=columns, filters=filters, stream=True)
 
     headers = next(report)
     headers.append('Timestamp')
-    for row in report:
-        row.append(timestamp.strftime("%Y-%m-%d %H:%M"))
-        row = {k: v for k, v in zip(headers, row)}
-        sql.insert_or_update(table='factPickedInventory', key=headers[:-1], record=row)
+    picked_at = timestamp.strftime("%Y-%m-%d %H:%M")
+    pipeline.run(report, pipeline.upsert_sink('factPickedInventory', key=headers[:-1], columns=headers),
+                 stages=[lambda rows: [row + [picked_at] for row in rows]], name='factPickedInventory')
 
-async def process_invoice_report (days: int=28) -> None:
+def process_invoice_report (days: int=28) -> None:
 
     timestamp = datetime.datetime.now(pytz.timezone('US/Eastern'))
-    from_threshold = (timestamp - datetime.timedelta(days=days)).strftime("%Y-%m-%d 00:00")
-    to_threshold = timestamp.strftime("%Y-%m-%d 23:59")
+    window = sync_window('factInvoice', timestamp, days)
+    from_threshold = window.from_threshold.strftime("%Y-%m-%d %H:%M")
+    to_threshold = window.to_threshold.strftime("%Y-%m-%d %H:%M")
 
     report_code = 'invoice'
     columns = ['alternate_code_1', 'alternate_code_2', 'bill_to', 'charge_per_unit', 'customer_code', 'customer_name',
@@ -184,22 +253,19 @@ async def process_invoice_report (days: int=28) -> None:
     filters = [{'column': 'invoiced_at', 'operator': 'between', 'from_threshold': from_threshold,
                                                                 'to_threshold': to_threshold}]
 
-    report = nulogy.get_report(report_code=report_code, columns=columns, filters=filters)
+    report = nulogy.get_report(report_code=report_code, columns=columns, filters=filters, stream=True)
 
     headers = next(report)
-    report = [row for row in report]
-
-    sql.execute(f"DELETE FROM factInvoice WHERE [Invoice date] BETWEEN '{from_threshold}' AND '{to_threshold}'")
-
-    for row in report:
-        row = {k: v for k, v in zip(headers, row)}
-        sql.insert(table='factInvoice', record=row)
+    where = f"[Invoice date] BETWEEN '{from_threshold}' AND '{to_threshold}'"
+    pipeline.run(report, pipeline.replace_sink('factInvoice', headers, where), name='factInvoice')
+    sync.mark_synced('factInvoice', window)
 
-async def process_job_profitability_report (days: int=28) -> None:
+def process_job_profitability_report (days: int=28) -> None:
     
     timestamp = datetime.datetime.now(pytz.timezone('US/Eastern'))
-    from_threshold = (timestamp - datetime.timedelta(days=days)).strftime("%Y-%m-%d 00:00")
-    to_threshold = timestamp.strftime("%Y-%m-%d 23:59")
+    window = sync_window('factJobProfitability', timestamp, days)
+    from_threshold = window.from_threshold.strftime("%Y-%m-%d %H:%M")
+    to_threshold = window.to_threshold.strftime("%Y-%m-%d %H:%M")
 
     # Job Profitability Report
     report_code = 'job_profitability'
@@ -226,7 +292,8 @@ async def process_job_profitability_report (days: int=28) -> None:
     'total_charge_per_unit', 'unit_of_measure', 'units_expected', 'units_produced', 'units_remaining']
     filters = [{'column': 'actual_job_start_at', 'operator': 'between', 'from_threshold': from_threshold,
                                                                         'to_threshold': to_threshold}]
-    report = nulogy.get_report(report_code=report_code, columns=columns, filters=filters)
+    report = nulogy.get_report(report_code=report_code, columns=columns, filters=filters, stream=True,
+                               shards=REPORT_SHARDS if window.full else 1)
 
     # Item Master lookup table
     report_code = 'item_master'
@@ -236,28 +303,35 @@ async def process_job_profitability_report (days: int=28) -> None:
 
 
     headers = next(report)
+    item_code = headers.index('Item code')
+    unit_of_measure = headers.index('Unit of measure')
+    units_produced = headers.index('Units produced')
     headers.append('Base unit of measure')
     headers.append('Base units produced')
-    report = [row for row in report]
-
-    # remove old records
-    sql.execute(f"DELETE FROM factJobProfitability WHERE [Actual Job start date] BETWEEN '{from_threshold}' AND '{to_threshold}'")
-
-    for row in report:
-        row.append('')
-        row.append('')
-        row = {k: v for k, v in zip(headers, row)}
-
-        row['Base unit of measure'] = item_base_unit_lookup[row['Item code']]
-        row['Base units produced'] = nulogy.convertToBaseUnits(row['Item code'], row['Unit of measure'], row['Units produced'])
 
-        sql.insert(table='factJobProfitability', record=row)
+    def add_base_units(rows: List[list]) -> List[list]:
+        # Convert a batch in one pass; rows without a conversion are logged together and stored without base units.
+        base_units_produced = nulogy.convert_to_base_units([row[item_code] for row in rows],
+                                                           [row[unit_of_measure] for row in rows],
+                                                           [row[units_produced] for row in rows],
+                                                           errors='coerce')
+
+        for row, base_units in zip(rows, base_units_produced.tolist()):
+            row.append(item_base_unit_lookup[row[item_code]])
+            row.append(None if base_units != base_units else base_units)    # NaN -> NULL
+        return rows
+
+    where = f"[Actual Job start date] BETWEEN '{from_threshold}' AND '{to_threshold}'"
+    pipeline.run(report, pipeline.replace_sink('factJobProfitability', headers, where), stages=[add_base_units],
+                 name='factJobProfitability')
+    sync.mark_synced('factJobProfitability', window)
     
-async def process_labor_report (days: int=28) -> None:
+def process_labor_report (days: int=28) -> None:
 
     timestamp = datetime.datetime.now(pytz.timezone('US/Eastern'))
-    from_threshold = (timestamp - datetime.timedelta(days=days)).strftime("%Y-%m-%d 00:00")
-    to_threshold = timestamp.strftime("%Y-%m-%d 23:59")
+    window = sync_window('factLabor', timestamp, days)
+    from_threshold = window.from_threshold.strftime("%Y-%m-%d %H:%M")
+    to_threshold = window.to_threshold.strftime("%Y-%m-%d %H:%M")
     
     report_code = 'labor'
     columns = ['availability', 'badge_code', 'badge_type_name', 'badge_type_prefix', 'badge_type_rate', 
@@ -268,32 +342,47 @@ async def process_labor_report (days: int=28) -> None:
     filters = [{'column': 'clock_in_at', 'operator': 'between', 'from_threshold': from_threshold,
                                                                 'to_threshold': to_threshold}]
 
-    report = nulogy.get_report(report_code=report_code, columns=columns, filters=filters)
+    report = nulogy.get_report(report_code=report_code, columns=columns, filters=filters, stream=True)
 
     headers = next(report)
-    report = [row for row in report]
-
-    # remove old records
-    sql.execute(f"DELETE FROM factLabor WHERE [Clock in time] BETWEEN '{from_threshold}' AND '{to_threshold}'")
+    where = f"[Clock in time] BETWEEN '{from_threshold}' AND '{to_threshold}'"
+    pipeline.run(report, pipeline.replace_sink('factLabor', headers, where), name='factLabor')
+    sync.mark_synced('factLabor', window)
 
-    for row in report:
-        row = {k: v for k, v in zip(headers, row)}
-        sql.insert(table='factLabor', record=row)
-
-async def process_weekly_comsumption() -> None:
+def process_weekly_comsumption() -> None:
     #TODO Implement me    
     pass
 
-async def process_inventory_snapshot () -> None:
-
-    timestamp = datetime.datetime.now(pytz.timezone('US/Eastern'))
-
-    report_code = "inventory_snapshot"
-    columns = ["pallet_number", "item_type", "customer_name"]
-    report = nulogy.get_report(report_code=report_code, columns=columns)
-    field_names = next(report)
-    df = pd.DataFrame.from_records(report, columns=field_names)
-
+def _prefix_trie(rules: dict) -> dict:
+    trie = {}
+    for prefix, warehouse in rules.items():
+        node = trie
+        for character in prefix:
+            node = node.setdefault(character, {})
+        node[None] = warehouse      # None marks the end of a prefix
+    return trie
+
+def classify_warehouses(locations: pd.Series, rules: dict=WAREHOUSE_RULES, default: str='Other') -> pd.Series:
+    """
+    Maps each location to the warehouse of its longest matching prefix in rules. Each distinct
+    location is looked up once in a prefix trie, so the cost follows the number of unique locations.
+    """
+    trie = _prefix_trie(rules)
+
+    def classify(location: str) -> str:
+        node, warehouse = trie, default
+        for character in location:
+            node = node.get(character)
+            if node is None:
+                break
+            warehouse = node.get(None, warehouse)
+        return warehouse
+
+    return locations.map({location: classify(location) for location in locations.unique()})
+
+def process_inventory_snapshot () -> None:
+
+    timestamp = datetime.datetime.now(pytz.timezone('US/Eastern')).strftime("%Y-%m-%d %H:%M")
 
     report_code = "pallet_aging"
     columns = ["location", "pallet_number"]
@@ -303,53 +392,96 @@ async def process_inventory_snapshot () -> None:
     pallet_aging_df.rename(columns={"Pallet number": "Pallet Number"}, inplace=True)  # Rename column to match inventory_snapshop_df
 
 
-    df = df.merge(pallet_aging_df, on='Pallet Number', how='left')
-    df['timestamp'] = timestamp.strftime("%Y-%m-%d %H:%M")
+    report_code = "inventory_snapshot"
+    columns = ["pallet_number", "item_type", "customer_name"]
+    report = nulogy.get_report(report_code=report_code, columns=columns, stream=True)
+    field_names = next(report)
 
-    df.drop_duplicates(inplace=True)
-    logging.info(f"Inserting {len(df)} rows into factInventory")
-    df.to_sql('factInventory', sql.engine, if_exists='append', index=False, chunksize=1000)
+    seen = np.empty(0, dtype='uint64')     # sorted hashes of the rows written so far, to drop duplicates across batches
 
-    
-    logging.info('Processing inventory summary')
+    def to_frame(rows: List[list]) -> pd.DataFrame:
+        nonlocal seen
+        df = pd.DataFrame.from_records(rows, columns=field_names)
+        df = df.merge(pallet_aging_df, on='Pallet Number', how='left')
+        df['timestamp'] = timestamp
 
-    # Add Warehouse column
-    df['Warehouse'] = 'Other'
-    df.fillna(value={'Location': ''}, inplace=True)
-    df.loc[map(lambda l: l.startswith('B')          , df['Location']), 'Warehouse'] = 'Burnett'
-    df.loc[map(lambda l: l.startswith('L')          , df['Location']), 'Warehouse'] = 'Locust'
-    df.loc[map(lambda l: l.startswith('D')          , df['Location']), 'Warehouse'] = 'Dixie'
-    df.loc[map(lambda l: l.startswith('Line')       , df['Location']), 'Warehouse'] = 'Dixie'
-    df.loc[map(lambda l: l.startswith('LW')         , df['Location']), 'Warehouse'] = 'Locust West'
-    df.loc[map(lambda l: l.startswith('LOCUST WEST'), df['Location']), 'Warehouse'] = 'Locust West'
+        hashes = row_hashes(df)
+        keep = ~pd.Series(hashes).duplicated().to_numpy() & ~np.isin(hashes, seen)
+        seen = np.union1d(seen, hashes[keep])
+        return df[keep]
 
+    pallets = set()     # (warehouse, pallet number) pairs for the summary
 
-    summary_df = df[['timestamp', 'Warehouse', 'Pallet Number']].drop_duplicates()
-    summary_df = summary_df.groupby(['timestamp', 'Warehouse']).count()
+    def write_inventory(frames: Iterator[pd.DataFrame]) -> int:
+        def tracked(frames: Iterator[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+            for df in frames:
+                warehouses = classify_warehouses(df['Location'].fillna(''))
+                pallets.update(zip(warehouses, df['Pallet Number']))
+                yield df
+        return sql.write_frames(tracked(frames), 'factInventory')
+
+    written = pipeline.run(report, write_inventory, stages=[to_frame], name='factInventory')
+    logging.info(f"Inserted {written} rows into factInventory")
+
+    
+    logging.info('Processing inventory summary')
+
+    summary_df = pd.DataFrame(list(pallets), columns=['Warehouse', 'Pallet Number'])
+    summary_df = summary_df.groupby('Warehouse').count()
     summary_df.reset_index(inplace=True)
-    summary_df.rename(columns={'timestamp': 'Date','Pallet Number': 'Pallet Count'}, inplace=True)
+    summary_df.insert(0, 'Date', timestamp)
+    summary_df.rename(columns={'Pallet Number': 'Pallet Count'}, inplace=True)
 
     logging.info(f"Inserting {len(summary_df)} rows into factInventorySummary")
-    summary_df.to_sql('factInventorySummary', sql.engine, if_exists='append', index=False)
+    sql.write_frame(summary_df, 'factInventorySummary')
+
+
+
+def run_job(job) -> None:
+    logging.info(f"==Starting {job.__name__}... {timestamp()}")
+    with metrics.span(job.__name__):
+        job()
+    logging.info(f"==Finished {job.__name__}... {timestamp()}")
 
+async def run_jobs(jobs: list, max_concurrent: int=MAX_CONCURRENT_JOBS) -> None:
+    """
+    Run the blocking report pipelines on a bounded thread pool and wait for all of them.
+    A failing pipeline does not stop the others; the first failure is raised once all are done.
+    """
+    loop = asyncio.get_running_loop()
 
+    with ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix='nightly') as executor:
+        results = await asyncio.gather(*[loop.run_in_executor(executor, contextvars.copy_context().run, run_job, job) for job in jobs],
+                                       return_exceptions=True)
 
+    errors = [(job, result) for job, result in zip(jobs, results) if isinstance(result, BaseException)]
+    for job, error in errors:
+        logging.error(f"{job.__name__} failed: {error!r}")
+
+    if errors:
+        raise errors[0][1]
+
+@metrics.timed('NightlyDBUpdates')
 async def main(mytimer: func.TimerRequest) -> None:
     est_timestamp = datetime.datetime.now(pytz.timezone('US/Eastern'))
 
     if mytimer.past_due:
         logging.info('The timer is past due!')
 
-    await asyncio.gather(
-        process_ship_orders(),
-        process_shipments(),
-        process_receipts(),
-        process_moves(),
-        process_picks(),
-        process_labor_report(),
-        process_invoice_report(),
-        process_job_profitability_report(),
-        process_inventory_snapshot()
-    )
-
+    # Every pipeline needs both; fetch them from Key Vault at the same time instead of on first use.
+    config.get_secrets('NULOGY_SECRET_KEY', 'AZURE_DB_CONNECTION_STRING')
+
+    await run_jobs([
+        process_ship_orders,
+        process_shipments,
+        process_receipts,
+        process_moves,
+        process_picks,
+        process_labor_report,
+        process_invoice_report,
+        process_job_profitability_report,
+        process_inventory_snapshot
+    ])
+
+    logging.info(f"SQL connection pool: {sql.get_pool_stats()}")
     logging.info('Python timer trigger function ran at %s', est_timestamp)
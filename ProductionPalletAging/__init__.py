@@ -1,15 +1,27 @@
 import azure.functions as func
 import utils.nulogy as nu
+import utils.metrics as metrics
+import utils.powerbi as powerbi
+import utils.state as state
+from utils.alerts import Alert, AlertDispatcher, recipients
 import datetime
+import hashlib
+import html
+import json
+import os
 import pytz
 import logging
-import requests
-import json
-from typing import List
+from typing import Dict, Iterator, List, NamedTuple
 
 # Const to set the maximum age of a pallet in minutes before notification is sent.
 MAX_PALLET_AGE_MINUTES = 15
 
+# Comma separated addresses that get an email when pallets on the lines get older than MAX_PALLET_AGE_MINUTES.
+ALERT_RECIPIENTS_SETTING = 'PALLET_ALERT_RECIPIENTS'
+
+# Namespace of the pallet tracker in the local state store.
+STATE_NAMESPACE = 'pallet_aging'
+
 class EST(datetime.tzinfo):
     def utcoffset(self, dt):
         return datetime.timedelta(hours = -5)
@@ -30,11 +42,11 @@ class EDT(datetime.tzinfo):
     def dst(self, dt):
         return datetime.timedelta(0)
 
-def format_message(data: List[list]) -> str:
+def format_message(data: List[list]) -> Iterator[str]:
     """
-    Format the data into an HTML table for the email message.
+    Format the data into an HTML table for the email message, yielded piece by piece.
     """
-    msg = """
+    yield """
     <html>
     <head>
         <meta http-equiv="Content-Type" content="text/html; charset=us-ascii">
@@ -57,13 +69,13 @@ def format_message(data: List[list]) -> str:
             <th>Full Pallet %</th>
         </tr>"""
     for line in data:            
-        location   = line[0]
-        pallet     = line[1]
-        item       = line[2]
+        location   = html.escape(line[0])
+        pallet     = html.escape(line[1])
+        item       = html.escape(line[2])
         age        = int(line[3])
         pallet_pct = float(line[4])
 
-        msg += f"""
+        yield f"""
         <tr>
           <td>{location}</td>
           <td>{pallet}</td>
@@ -72,11 +84,10 @@ def format_message(data: List[list]) -> str:
           <td style="text-align: center">{pallet_pct:.0%}</td>
         </tr>"""
 
-    msg += """
+    yield """
         </table>
     </body>
     </html>"""
-    return msg
 
 def get_aged_pallets(report: List[list]) -> int:
     """
@@ -88,6 +99,61 @@ def get_aged_pallets(report: List[list]) -> int:
             aged_pallet_count += 1
     return aged_pallet_count
 
+class PalletSnapshot(NamedTuple):
+    rows            : List[list]            # report rows with the dwell time in minutes as the age
+    first_seen      : Dict[str, str]        # pallet -> ISO time it was first seen on a line
+    content_hash    : str
+    aged            : List[str]             # pallets older than MAX_PALLET_AGE_MINUTES
+    changed         : bool
+
+def track_pallets(report: List[list], now: datetime.datetime, store: state.StateStore) -> PalletSnapshot:
+    """
+    Compare the pallets on the lines with the last pushed snapshot in the state store.
+
+    Each pallet's dwell time is counted from the first time it was seen (or the time in storage Nulogy
+    reports, if that is earlier). The snapshot has changed when pallets, locations, items or quantities
+    differ from the last push, or when a pallet crossed MAX_PALLET_AGE_MINUTES since then.
+    """
+    previous = store.get_all(STATE_NAMESPACE)
+    previous_first_seen = previous.get('first_seen', {})
+
+    rows = []
+    first_seen = {}
+    for line in report:
+        pallet = line[1]
+        since = now - datetime.timedelta(minutes=int(line[3]))
+        if pallet in previous_first_seen:
+            since = min(since, datetime.datetime.fromisoformat(previous_first_seen[pallet]))
+        first_seen[pallet] = since.isoformat()
+        rows.append([line[0], pallet, line[2], int((now - since).total_seconds() // 60), line[4]])
+
+    # ages are left out of the hash, they change on every run
+    content = sorted([location, pallet, item, quantity] for location, pallet, item, _, quantity in rows)
+    content_hash = hashlib.sha1(json.dumps(content).encode('utf-8')).hexdigest()
+    aged = sorted(row[1] for row in rows if row[3] > MAX_PALLET_AGE_MINUTES)
+
+    changed = content_hash != previous.get('content_hash') or aged != previous.get('aged')
+    return PalletSnapshot(rows, first_seen, content_hash, aged, changed)
+
+def send_aged_pallet_alerts(snapshot: PalletSnapshot, now: datetime.datetime, store: state.StateStore) -> None:
+    """
+    Email the pallets that are over MAX_PALLET_AGE_MINUTES, in one message to all recipients. A pallet
+    is only included again once its alert cooldown has passed.
+    """
+    to = recipients(ALERT_RECIPIENTS_SETTING)
+    if not snapshot.aged or not to:
+        return
+
+    dispatcher = AlertDispatcher('aged_pallets', store=store)
+    due = set(dispatcher.due(snapshot.aged, now))
+    if not due:
+        return
+
+    rows = [row for row in snapshot.rows if row[1] in due]
+    subject = f"{len(due)} pallet{'s' if len(due) > 1 else ''} on the lines older than {MAX_PALLET_AGE_MINUTES} minutes"
+    dispatcher.dispatch([Alert(to, subject, format_message(rows), sorted(due))], now)
+
+@metrics.timed('ProductionPalletAging')
 def main(mytimer: func.TimerRequest) -> None:
 
     if mytimer.past_due:
@@ -100,20 +166,33 @@ def main(mytimer: func.TimerRequest) -> None:
 
     report = nu.get_report(report_code=report_code, columns=columns, filters=filters, headers=False)
 
-    dashboard_url = 'https://api.powerbi.com/beta/49705843-c33c-42c0-aced-f21acaabd4fc/datasets/e69d4235-d54d-4cb1-a026-7bbd9215c27a/rows?key=iDdR5%2FDOVOF4chFYQ5A1NZcDDNe5Jde8S7aBMzDsoVyEL%2B%2By8SM4H%2FJior5ZyRgNrIrQfFL5b2xxNetGuVU7aA%3D%3D'
-    dashboard_headers = {
-        "Content-Type": "application/json"
-    }
+    now = datetime.datetime.now(pytz.timezone('US/Eastern'))
+    store = state.StateStore()
+    snapshot = track_pallets(report, now, store)
+    logging.info(f"{len(snapshot.rows)} pallets on the lines, {get_aged_pallets(snapshot.rows)} older than {MAX_PALLET_AGE_MINUTES} minutes")
 
+    try:
+        send_aged_pallet_alerts(snapshot, now, store)
+    except Exception as e:
+        # a mail outage shouldn't hold up the dashboard
+        logging.error(f"Unable to send aged pallet alerts: {e!r}")
+
+    if not snapshot.changed:
+        logging.info("Pallets on the lines unchanged since the last push")
+        return
+
+    dashboard_url = os.environ.get('PALLET_AGING_PUSH_URL', 'https://api.powerbi.com/beta/49705843-c33c-42c0-aced-f21acaabd4fc/datasets/e69d4235-d54d-4cb1-a026-7bbd9215c27a/rows?key=iDdR5%2FDOVOF4chFYQ5A1NZcDDNe5Jde8S7aBMzDsoVyEL%2B%2By8SM4H%2FJior5ZyRgNrIrQfFL5b2xxNetGuVU7aA%3D%3D')
+
+    timestamp = now.strftime("%m/%d/%Y %H:%M:%S")
     data = []
-    for line in report:
+    for line in snapshot.rows:
         data.append({
             "location"                  : line[0],
             "pallet_number"             : line[1],
             "item_code"                 : line[2],
-            "time_in_storage_minutes"   : int(line[3]),
+            "time_in_storage_minutes"   : line[3],
             "full_pallet_quantity"      : f"{float(line[4]):0.0%}",
-            "timestamp"                 : datetime.datetime.now(pytz.timezone('US/Eastern')).strftime("%m/%d/%Y %H:%M:%S"),
+            "timestamp"                 : timestamp,
         })
 
     if not data:
@@ -124,7 +203,12 @@ def main(mytimer: func.TimerRequest) -> None:
             "time_in_storage_minutes"   : 0,
             "full_pallet_quantity"      : ''
         })
-    data = json.dumps(data)
-    r = requests.post(url=dashboard_url, headers=dashboard_headers, data=data)
 
-    logging.info(f'Push to PowerBI Status Code: {r.status_code}')
+    powerbi.push_rows(dashboard_url, data)
+
+    # Only remember the snapshot once it has been pushed, so a failed push is retried on the next run.
+    store.put(STATE_NAMESPACE, {
+        "first_seen"    : snapshot.first_seen,
+        "content_hash"  : snapshot.content_hash,
+        "aged"          : snapshot.aged,
+    })
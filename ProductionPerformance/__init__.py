@@ -1,10 +1,13 @@
 import azure.functions as func
 import utils.nulogy as nu
+import utils.metrics as metrics
+import utils.schema as schema
+import utils.powerbi as powerbi
 import datetime
+import os
 import pytz
 import logging
-import requests
-import json
+import pandas as pd
 
 class EST(datetime.tzinfo):
     def utcoffset(self, dt):
@@ -27,6 +30,7 @@ class EDT(datetime.tzinfo):
         return datetime.timedelta(0)
 
 
+@metrics.timed('ProductionPerformance')
 def main(mytimer: func.TimerRequest) -> None:
     utc_timestamp = datetime.datetime.utcnow().replace(
         tzinfo=datetime.timezone.utc).isoformat()
@@ -39,28 +43,26 @@ def main(mytimer: func.TimerRequest) -> None:
     filters = [{"column": "actual_job_start_at", "operator": "today"}, {"column": "job_status", "operator": "=", "threshold": "started"}]
     sort_by = [{"column": "line_name", "direction": 'asc'}]
 
-    report = nu.get_report(report_code=report_code, columns=columns, filters=filters, sort_by=sort_by, headers=False)
+    report = nu.get_report(report_code=report_code, columns=columns, filters=filters, sort_by=sort_by)
+    report = schema.parse_report(report_code, columns, report, rename=True)
 
-    dashboard_url = 'https://api.powerbi.com/beta/49705843-c33c-42c0-aced-f21acaabd4fc/datasets/ff1b61c5-421a-4424-a596-35d68348df75/rows?key=G6DhhScPHvGSTC7WqUVA1KV2IYzDUk21toQcGmYo9jzvTdSAwV7tqhICbF9f4%2FwQ2PIMdx5zWpfh9Z%2Fbsl95fg%3D%3D'
-    dashboard_headers = {
-        "Content-Type": "application/json"
-    }
+    dashboard_url = os.environ.get('PRODUCTION_PERFORMANCE_PUSH_URL', 'https://api.powerbi.com/beta/49705843-c33c-42c0-aced-f21acaabd4fc/datasets/ff1b61c5-421a-4424-a596-35d68348df75/rows?key=G6DhhScPHvGSTC7WqUVA1KV2IYzDUk21toQcGmYo9jzvTdSAwV7tqhICbF9f4%2FwQ2PIMdx5zWpfh9Z%2Fbsl95fg%3D%3D')
 
-    data = []
-    for line in report:
-        data.append({
-            "line_name"         : line[1],
-            "line_leader"       : line[2],
-            "units_produced"    : float(line[3]),
-            "units_remaining"   : float(line[4]) if float(line[4]) >= 0 else 0,
-            "unit_of_measure"   : line[5],
-            "line_performance"  : float(line[6].replace('%','')),
-            "line_availability" : float(line[7].replace('%','')),
-            "line_effeciency"   : float(line[8].replace('%','')),
-            "timestamp"         : datetime.datetime.now(pytz.timezone('US/Eastern')).strftime("%m/%d/%Y %H:%M:%S"),
-            "percent_complete"  : f"{float(line[9].replace('%','')):0.0f}%",
-            "job_id"            : line[0]
-        })
+    timestamp = datetime.datetime.now(pytz.timezone('US/Eastern')).strftime("%m/%d/%Y %H:%M:%S")
+    data = pd.DataFrame({
+        "line_name"         : report["line_name"].astype(object),
+        "line_leader"       : report["line_leader_name"].astype(object),
+        "units_produced"    : report["units_produced"],
+        "units_remaining"   : report["units_remaining"].clip(lower=0),
+        "unit_of_measure"   : report["unit_of_measure"].astype(object),
+        "line_performance"  : report["performance"],
+        "line_availability" : report["availability"],
+        "line_effeciency"   : report["line_efficiency"],
+        "timestamp"         : timestamp,
+        "percent_complete"  : report["percent_complete"].map(lambda pct: f"{pct:0.0f}%", na_action="ignore"),
+        "job_id"            : report.iloc[:, 0]
+    })
+    data = data.astype(object).where(data.notna(), None).to_dict(orient='records')
 
     if not data:
         data.append({
@@ -72,11 +74,10 @@ def main(mytimer: func.TimerRequest) -> None:
             "line_performance" :0,
             "line_availability" :0,
             "line_effeciency" :0,
-            "timestamp" :datetime.datetime.now(pytz.timezone('US/Eastern')).strftime("%m/%d/%Y %H:%M:%S"),
+            "timestamp" :timestamp,
             "percent_complete" :"",
             "job_id" :""
         })
-    data = json.dumps(data)
-    r = requests.post(url=dashboard_url, headers=dashboard_headers, data=data)
 
-    logging.info(f'Push to PowerBI Status Code: {r.status_code}')
+    # Skip the push when nothing but the timestamp changed since the last one (e.g. overnight).
+    powerbi.push_rows(dashboard_url, data, delta='payload')
@@ -2,10 +2,61 @@ import datetime
 import logging
 import azure.functions as func
 import pandas as pd
-import numpy as np
-from utils import nulogy, sql
+from utils import config, metrics, nulogy, schema, sql
 
+TABLE = 'factItemMaster'
 
+# Columns the incremental load keeps next to Nulogy's: a hash of each item's values, to find the items
+# that changed, and a soft-delete flag for items that are no longer in the item master.
+HASH_COLUMN = 'Row Hash'
+DELETED_COLUMN = 'Deleted'
+
+def ensure_columns() -> None:
+    sql.execute(f"""
+IF COL_LENGTH('{TABLE}', '{HASH_COLUMN}') IS NULL
+    ALTER TABLE {TABLE} ADD [{HASH_COLUMN}] char(16) NULL;
+IF COL_LENGTH('{TABLE}', '{DELETED_COLUMN}') IS NULL
+    ALTER TABLE {TABLE} ADD [{DELETED_COLUMN}] bit NOT NULL CONSTRAINT DF_{TABLE}_Deleted DEFAULT 0;""")
+
+def row_hashes(df: pd.DataFrame) -> pd.Series:
+    return pd.util.hash_pandas_object(df, index=False).map('{:016x}'.format)
+
+def sync_item_master(items: pd.DataFrame, key: str) -> None:
+    """
+    Applies the item master to factItemMaster incrementally: new items and items whose values changed
+    (updated_at is one of the hashed values) are upserted on the key, items that disappeared from
+    Nulogy are flagged as deleted, and everything else is left untouched.
+    """
+    if items.empty:
+        raise Exception("Item master report is empty, not syncing")
+
+    ensure_columns()
+    items = items.dropna(subset=[key]).drop_duplicates(subset=[key], keep='last')
+    items[HASH_COLUMN] = row_hashes(items)
+    items[DELETED_COLUMN] = False
+
+    existing = pd.DataFrame.from_records(sql.query(f"SELECT [{key}], [{HASH_COLUMN}], [{DELETED_COLUMN}] FROM {TABLE}"),
+                                         columns=[key, 'existing_hash', 'existing_deleted'])
+    existing = existing.dropna(subset=[key]).drop_duplicates(subset=[key])
+    existing[key] = existing[key].astype(str)
+    merged = items[[key, HASH_COLUMN]].merge(existing, on=key, how='left')
+    changed = (merged[HASH_COLUMN] != merged['existing_hash']) | merged['existing_deleted'].fillna(False).astype(bool)
+    changed_items = items[changed.to_numpy()]
+
+    logging.info(f"{len(changed_items)} of {len(items)} items are new or changed")
+    if not changed_items.empty:
+        changed_items = changed_items.astype(object).where(changed_items.notna(), None)
+        sql.bulk_upsert(table=TABLE, key=[key], columns=list(changed_items.columns),
+                        rows=changed_items.itertuples(index=False, name=None))
+
+    missing = existing.loc[~existing[key].isin(items[key]) & ~existing['existing_deleted'].astype(bool), key]
+    logging.info(f"{len(missing)} items are no longer in Nulogy")
+    if not missing.empty:
+        sql.bulk_upsert(table=TABLE, key=[key], columns=[key, DELETED_COLUMN],
+                        rows=((uuid, True) for uuid in missing))
+
+
+@metrics.timed('UpdateItemMaster')
 def main(mytimer: func.TimerRequest) -> None:
     utc_timestamp = datetime.datetime.utcnow().replace(
         tzinfo=datetime.timezone.utc).isoformat()
@@ -13,6 +64,8 @@ def main(mytimer: func.TimerRequest) -> None:
     if mytimer.past_due:
         logging.info('The timer is past due!')
 
+    config.get_secrets('NULOGY_SECRET_KEY', 'AZURE_DB_CONNECTION_STRING')
+
     logging.info('Getting Item Master data from Nulogy')
 
     report_code = 'item_master'
@@ -34,14 +87,12 @@ def main(mytimer: func.TimerRequest) -> None:
                'track_lot_code_by','track_pallets','unit_purchase_price','updated_at','uuid','vendor','weight_per_case','weight_per_pallet']
 
     report = nulogy.get_report(report_code, columns)
+    nulogy_df = schema.parse_report(report_code, columns, report)
 
-    logging.info('Inserting Item Master data into SQL')
-    sql.execute(f"DELETE FROM factItemMaster")
-
-    field_names = next(report)
-    nulogy_df = pd.DataFrame.from_records(report, columns=field_names)
-    nulogy_df.replace(r'^\s*$', np.nan, regex=True, inplace=True)
-    nulogy_df.to_sql('factItemMaster', sql.engine, if_exists='replace', index=False, chunksize=1000)
+    logging.info('Updating Item Master data in SQL')
+    # requested columns are the last ones of the report, see schema.parse_report
+    uuid = nulogy_df.columns[len(nulogy_df.columns) - len(columns) + columns.index('uuid')]
+    sync_item_master(nulogy_df, key=uuid)
 
 
     #for row in report:
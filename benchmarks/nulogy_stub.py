@@ -0,0 +1,232 @@
+"""
+Local stand-in for the parts of the Nulogy reports API the functions use:
+
+    POST /api/reports/report_runs           submit a report run, returns a status_url
+    GET  /api/reports/report_runs/<id>      RUNNING until the run's delay has passed, then COMPLETED with a url
+    GET  /downloads/<id>.csv                the report as CSV, generated on the fly
+    POST /powerbi/<dataset>                 accepts Power BI push rows
+
+Reports are synthetic but use the requested columns, in order, with Nulogy-style headers, so every
+pipeline can run end to end. Values are derived from the column codes (dates for *_at, numbers for
+quantities, percentages, a shared pool of item codes with UOM ratios...) and are reproducible.
+"""
+import csv
+import io
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+# Reports where Nulogy adds a leading ID column that wasn't requested.
+LEADING_COLUMNS = {
+    "job_profitability" : "Job ID",
+    "job_productivity"  : "Job ID",
+}
+
+# Headers that don't follow the usual "Humanized column code" pattern.
+HEADER_OVERRIDES = {
+    ("inventory_snapshot", "pallet_number") : "Pallet Number",
+}
+
+ITEM_COUNT = 500
+UNITS = ["eaches", "cases", "pallets"]
+LOCATIONS = ["B-01-01", "B-02-04", "L-10-02", "D-03-01", "Line 4", "Line 7", "LW-01-01", "LOCUST WEST 3", "STAGE"]
+
+
+def header_for(report_code: str, column: str) -> str:
+    if (report_code, column) in HEADER_OVERRIDES:
+        return HEADER_OVERRIDES[(report_code, column)]
+    return column.replace('_', ' ').capitalize()
+
+def headers_for(report_code: str, columns: List[str]) -> List[str]:
+    headers = [header_for(report_code, column) for column in columns]
+    if report_code in LEADING_COLUMNS:
+        headers.insert(0, LEADING_COLUMNS[report_code])
+    return headers
+
+def _value(report_code: str, column: str, row: int, rng: random.Random) -> str:
+    item = row % ITEM_COUNT
+
+    if report_code == "uom_ratios":
+        return {"code": f"ITEM{item:05d}", "unit_of_measure": UNITS[1 + row // ITEM_COUNT % 2],
+                "ratio": "12" if row // ITEM_COUNT % 2 == 0 else "40", "conversion_unit_of_measure": UNITS[row // ITEM_COUNT % 2]}.get(column, '')
+    if column in ("code", "item_code", "original_item_code"):
+        return f"ITEM{item:05d}"
+    if column in ("base_unit_of_measure", "unit_of_measure", "default_unit_of_measure"):
+        return "eaches" if column == "base_unit_of_measure" else UNITS[row % len(UNITS)]
+    if column in ("location", "location_name", "from_location", "to_location", "pick_up_location", "drop_off_location"):
+        return LOCATIONS[row % len(LOCATIONS)]
+    if "pallet_number" in column:
+        return f"P{row:08d}"
+    if column == "uuid":
+        return str(uuid.UUID(int=row + 1))
+    if column.endswith("_at") or column.endswith("_date") or column == "expiry_date":
+        return time.strftime("%Y-%b-%d %I:%M %p", time.localtime(time.time() - rng.randint(0, 27 * 24 * 3600)))
+    if column in ("inactive", "invoiced", "shipped", "signed_off") or column.startswith("is_") or column.startswith("auto_"):
+        return rng.choice(["true", "false"])
+    if column in ("performance", "availability", "line_efficiency", "percent_complete", "labor_percentage_of_charge"):
+        return f"{rng.uniform(40, 120):.1f}%"
+    if column == "time_in_storage_minutes":
+        return str(rng.randint(0, 90))
+    if column == "full_pallet_quantity" and report_code == "pallet_aging":
+        return f"{rng.uniform(0, 1):.2f}"
+    if any(word in column for word in ("quantity", "units", "hours", "cost", "charge", "price", "profit", "margin",
+                                       "people", "personnel", "weight", "ratio", "duration", "rate", "amount", "number_of")):
+        return f"{rng.uniform(0, 5000):.2f}"
+    if column.endswith("_name") or column in ("customer", "vendor", "site_name"):
+        return f"{column.split('_')[0].title()} {rng.randint(1, 20)}"
+    return f"{column[:12]}-{rng.randint(0, 999)}"
+
+def generate_report(report_code: str, columns: List[str], rows: int, seed: int=0):
+    """
+        Yields the CSV text of a synthetic report one line at a time.
+    """
+    rng = random.Random(f"{report_code}-{seed}")
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow(headers_for(report_code, columns))
+    for row in range(rows):
+        values = [_value(report_code, column, row, rng) for column in columns]
+        if report_code in LEADING_COLUMNS:
+            values.insert(0, str(100000 + row))
+        writer.writerow(values)
+
+        if buffer.tell() > 64 * 1024:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+class NulogyStub():
+    """
+        Runs the stand-in on a background thread.
+
+            Parameter:
+                rows (dict)             : Rows per report code; report codes not listed use default_rows
+                default_rows (int)      : Rows for report codes not in rows
+                report_delay (float)    : Seconds a report run stays RUNNING before it completes
+    """
+    def __init__(self, rows: Dict[str, int]=None, default_rows: int=1000, report_delay: float=2.0, port: int=0):
+        self.rows = rows or {}
+        self.default_rows = default_rows
+        self.report_delay = report_delay
+        self.runs = {}
+        self.counts = {"submit": 0, "poll": 0, "download": 0, "rows": 0, "bytes": 0, "powerbi": 0}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self) -> "NulogyStub":
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, name: str, amount: int=1) -> None:
+        with self._lock:
+            self.counts[name] += amount
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.counts)
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _json(self, status: int, body: dict) -> None:
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _body(self) -> bytes:
+                return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            def do_POST(self):
+                body = self._body()
+                if self.path.startswith("/powerbi/"):
+                    stub.count("powerbi")
+                    return self._json(200, {})
+
+                if self.path != "/api/reports/report_runs":
+                    return self._json(404, {"error": "not found"})
+
+                request = json.loads(body)
+                run_id = uuid.uuid4().hex
+                with stub._lock:
+                    stub.runs[run_id] = {
+                        "report": request["report"],
+                        "columns": request["columns"],
+                        "ready_at": time.monotonic() + stub.report_delay,
+                    }
+                stub.count("submit")
+                self._json(201, {"status_url": f"{stub.url}/api/reports/report_runs/{run_id}"})
+
+            def do_GET(self):
+                if self.path.startswith("/api/reports/report_runs/"):
+                    stub.count("poll")
+                    run = stub.runs.get(self.path.rsplit('/', 1)[-1])
+                    if run is None:
+                        return self._json(404, {"error": "not found"})
+                    if time.monotonic() < run["ready_at"]:
+                        return self._json(200, {"status": "RUNNING"})
+                    return self._json(200, {"status": "COMPLETED", "url": f"{stub.url}/downloads/{self.path.rsplit('/', 1)[-1]}.csv"})
+
+                if self.path.startswith("/downloads/"):
+                    stub.count("download")
+                    run = stub.runs.get(self.path.rsplit('/', 1)[-1].split('.')[0])
+                    if run is None:
+                        return self._json(404, {"error": "not found"})
+
+                    rows = stub.rows.get(run["report"], stub.default_rows)
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/csv")
+                    self.send_header("Transfer-Encoding", "chunked")
+                    self.end_headers()
+                    for text in generate_report(run["report"], run["columns"], rows):
+                        data = text.encode('utf-8')
+                        self.wfile.write(f"{len(data):X}\r\n".encode('ascii') + data + b"\r\n")
+                        stub.count("bytes", len(data))
+                    self.wfile.write(b"0\r\n\r\n")
+                    stub.count("rows", rows)
+                    return
+
+                self._json(404, {"error": "not found"})
+
+        return Handler
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve the local Nulogy stand-in until interrupted.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--rows", type=int, default=1000, help="rows per report")
+    parser.add_argument("--report-delay", type=float, default=2.0, help="seconds before a report run completes")
+    args = parser.parse_args()
+
+    stub = NulogyStub(default_rows=args.rows, report_delay=args.report_delay, port=args.port).start()
+    print(f"Nulogy stand-in listening on {stub.url}")
+    try:
+        stub.thread.join()
+    except KeyboardInterrupt:
+        stub.stop()
@@ -0,0 +1,214 @@
+"""
+Offline benchmark of the report pipelines and timer functions.
+
+Runs everything against the local Nulogy stand-in (benchmarks/nulogy_stub.py) and a local SQL Server,
+so nothing touches production Nulogy, Azure SQL or Power BI. For each pipeline it records wall time,
+rows per second, peak Python memory, Nulogy round trips and SQL connections opened/reused, and writes
+them to a JSON file that can be diffed between commits.
+
+    docker run -e ACCEPT_EULA=Y -e MSSQL_SA_PASSWORD=Bench-Passw0rd -p 1433:1433 -d mcr.microsoft.com/mssql/server:2022-latest
+
+    export AZURE_DB_CONNECTION_STRING="Driver={ODBC Driver 18 for SQL Server};Server=localhost;Database=master;Uid=sa;Pwd=Bench-Passw0rd;TrustServerCertificate=yes"
+    python -m benchmarks.run --rows 20000 --output bench_results.json
+
+Fact tables are (re)created from the column lists in the function sources, with every column as nvarchar.
+"""
+import argparse
+import ast
+import asyncio
+import datetime
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+from benchmarks.nulogy_stub import NulogyStub, headers_for
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# table: (function module, function name, report code, extra columns the pipeline adds)
+REPORT_TABLES = {
+    "factShipOrder"         : ("NightlyDBUpdates", "process_ship_orders", "ship_order", []),
+    "factShipment"          : ("NightlyDBUpdates", "process_shipments", "shipment_item", []),
+    "factReceipt"           : ("NightlyDBUpdates", "process_receipts", "receipt_item", []),
+    "factMove"              : ("NightlyDBUpdates", "process_moves", "move_transaction", []),
+    "factPickedInventory"   : ("NightlyDBUpdates", "process_picks", "picked_inventory", ["Timestamp"]),
+    "factInvoice"           : ("NightlyDBUpdates", "process_invoice_report", "invoice", []),
+    "factJobProfitability"  : ("NightlyDBUpdates", "process_job_profitability_report", "job_profitability",
+                               ["Base unit of measure", "Base units produced"]),
+    "factLabor"             : ("NightlyDBUpdates", "process_labor_report", "labor", []),
+    "factItemMaster"        : ("UpdateItemMaster", "main", "item_master", []),
+}
+
+OTHER_TABLES = {
+    "factInventory"         : ["Pallet Number", "Item type", "Customer name", "Location", "timestamp"],
+    "factInventorySummary"  : ["Date", "Warehouse", "Pallet Count"],
+    "PRODUCTION_RECORDS"    : ["Job ID", "Line Name", "Line Leader", "Actual Job End Date", "Work Order Customer",
+                               "Item Code", "Units Expected", "Units Produced", "Pallets Produced", "Standard People",
+                               "Actual People", "Actual Hours", "Line Efficiency", "Invoiced"],
+}
+
+
+class Timer():
+    past_due = False
+
+
+def report_columns(module: str, function: str, report_code: str) -> List[str]:
+    """
+        Reads the column list a function requests for a report code straight from its source.
+    """
+    with open(os.path.join(ROOT, module, "__init__.py")) as file:
+        tree = ast.parse(file.read())
+
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node.name == function:
+            found = False
+            for statement in ast.walk(node):
+                if not isinstance(statement, ast.Assign) or not isinstance(statement.targets[0], ast.Name):
+                    continue
+                name = statement.targets[0].id
+                if name == "report_code" and isinstance(statement.value, ast.Constant):
+                    found = statement.value.value == report_code
+                elif name == "columns" and found:
+                    return ast.literal_eval(statement.value)
+    raise Exception(f"No {report_code} columns found in {module}.{function}")
+
+def create_tables(sql) -> None:
+    tables = dict(OTHER_TABLES)
+    for table, (module, function, report_code, extra) in REPORT_TABLES.items():
+        tables[table] = headers_for(report_code, report_columns(module, function, report_code)) + extra
+
+    for table, columns in tables.items():
+        sql.execute(f"DROP TABLE IF EXISTS {table}")
+        sql.execute(f"CREATE TABLE {table} ({', '.join(f'[{column}] nvarchar(400) NULL' for column in columns)})")
+    sql.execute("DROP TABLE IF EXISTS syncState")
+
+def benchmarks() -> Dict[str, Callable[[], None]]:
+    import NightlyDBUpdates
+    import JobProductivity
+    import ProductionPerformance
+    import ProductionPalletAging
+    import UpdateItemMaster
+
+    jobs = {job.__name__: job for job in [
+        NightlyDBUpdates.process_ship_orders,
+        NightlyDBUpdates.process_shipments,
+        NightlyDBUpdates.process_receipts,
+        NightlyDBUpdates.process_moves,
+        NightlyDBUpdates.process_picks,
+        NightlyDBUpdates.process_labor_report,
+        NightlyDBUpdates.process_invoice_report,
+        NightlyDBUpdates.process_job_profitability_report,
+        NightlyDBUpdates.process_inventory_snapshot,
+    ]}
+    jobs["NightlyDBUpdates.main"] = lambda: asyncio.run(NightlyDBUpdates.main(Timer()))
+    jobs["JobProductivity.main"] = lambda: JobProductivity.main(Timer())
+    jobs["ProductionPerformance.main"] = lambda: ProductionPerformance.main(Timer())
+    jobs["ProductionPalletAging.main"] = lambda: ProductionPalletAging.main(Timer())
+    jobs["UpdateItemMaster.main"] = lambda: UpdateItemMaster.main(Timer())
+    return jobs
+
+def reset_state(nulogy, sql) -> None:
+    # every run starts cold: no cached reports, UOMs, sync watermarks or tracked pallets
+    from utils import state
+    state.StateStore().delete("pallet_aging", "first_seen", "content_hash", "aged")
+    nulogy.report_cache.clear()
+    nulogy.report_durations.clear()
+    nulogy.uoms = None
+    nulogy.uom_index = None
+    sql.execute("IF OBJECT_ID('syncState') IS NOT NULL DELETE FROM syncState")
+
+def run_benchmark(name: str, job: Callable[[], None], stub: NulogyStub, sql) -> dict:
+    requests_before = stub.snapshot()
+    pool_before = sql.get_pool_stats()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    error = None
+    try:
+        job()
+    except Exception as e:
+        logging.exception(f"{name} failed")
+        error = repr(e)
+    elapsed = time.perf_counter() - start
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    requests_after = stub.snapshot()
+    pool_after = sql.get_pool_stats()
+    nulogy_requests = {key: requests_after[key] - requests_before[key] for key in requests_after}
+    rows = nulogy_requests.pop("rows")
+
+    return {
+        "name"                      : name,
+        "ok"                        : error is None,
+        "error"                     : error,
+        "wall_seconds"              : round(elapsed, 3),
+        "rows"                      : rows,
+        "rows_per_second"           : round(rows / elapsed, 1) if elapsed else None,
+        "peak_memory_bytes"         : peak_memory,
+        "nulogy_requests"           : nulogy_requests,
+        "sql_connections_opened"    : pool_after["opened"] - pool_before["opened"],
+        "sql_connections_reused"    : pool_after["reused"] - pool_before["reused"],
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=5000, help="rows in each synthetic report")
+    parser.add_argument("--rows-for", action="append", default=[], metavar="REPORT=ROWS",
+                        help="rows for one report code, e.g. shipment_item=100000 (repeatable)")
+    parser.add_argument("--report-delay", type=float, default=2.0, help="seconds each report run takes to complete")
+    parser.add_argument("--only", action="append", default=[], help="run only the named benchmark (repeatable)")
+    parser.add_argument("--repeat", type=int, default=1, help="runs of each benchmark")
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(message)s")
+
+    if "AZURE_DB_CONNECTION_STRING" not in os.environ:
+        sys.exit("Set AZURE_DB_CONNECTION_STRING to a local SQL Server database (see the module docstring).")
+
+    rows = {report: int(count) for report, count in (option.split("=", 1) for option in args.rows_for)}
+    stub = NulogyStub(rows=rows, default_rows=args.rows, report_delay=args.report_delay).start()
+
+    # Point the functions at the stand-ins before anything imports utils.config.
+    os.environ["NULOGY_REPORTS_URL"] = f"{stub.url}/api/reports/report_runs"
+    os.environ.setdefault("NULOGY_SECRET_KEY", "benchmark")
+    os.environ.setdefault("SMTP_USERNAME", "benchmark@localhost")
+    os.environ.setdefault("SMTP_PASSWORD", "benchmark")
+    os.environ["PRODUCTION_PERFORMANCE_PUSH_URL"] = f"{stub.url}/powerbi/production_performance"
+    os.environ["PALLET_AGING_PUSH_URL"] = f"{stub.url}/powerbi/pallet_aging"
+    sys.path.insert(0, ROOT)
+
+    from utils import nulogy, sql
+
+    create_tables(sql)
+    jobs = benchmarks()
+    selected = args.only or list(jobs)
+
+    results = []
+    try:
+        for name in selected:
+            for _ in range(args.repeat):
+                reset_state(nulogy, sql)
+                result = run_benchmark(name, jobs[name], stub, sql)
+                print(f"{name:40} {result['wall_seconds']:>9.2f}s {result['rows_per_second'] or 0:>12,.0f} rows/s "
+                      f"{result['peak_memory_bytes'] / 2**20:>8.1f} MiB {'' if result['ok'] else 'FAILED'}")
+                results.append(result)
+    finally:
+        stub.stop()
+
+    with open(args.output, "w") as file:
+        json.dump({
+            "created_at"    : datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "config"        : {"rows": args.rows, "rows_for": rows, "report_delay": args.report_delay},
+            "results"       : results,
+        }, file, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
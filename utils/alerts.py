@@ -0,0 +1,82 @@
+import datetime
+import logging
+import os
+from typing import Dict, Iterable, List, NamedTuple, Optional, Union
+from utils import state
+from utils.email import Email
+
+# Minutes before an alert for the same key (e.g. a pallet number) is sent again.
+ALERT_COOLDOWN_MINUTES = int(os.environ.get('ALERT_COOLDOWN_MINUTES', 60))
+
+
+class Alert(NamedTuple):
+    to          : List[str]
+    subject     : str
+    body        : Union[str, Iterable[str]]
+    keys        : List[str]                 # what the alert is about, for the cooldown
+    attachments : List[str] = []
+
+
+def recipients(setting: str) -> List[str]:
+    """
+        Reads a comma or semicolon separated list of addresses from an app setting.
+    """
+    value = os.environ.get(setting, '')
+    return [address.strip() for address in value.replace(';', ',').split(',') if address.strip()]
+
+
+class AlertDispatcher():
+    """
+        Sends alerts at most once per cooldown for each key, so a condition that persists over many timer
+        runs (a pallet that stays aged) doesn't send a message every run. The time each key was last alerted
+        is kept in the local state store. All alerts of a dispatch go out over one SMTP session.
+
+            dispatcher = AlertDispatcher('aged_pallets')
+            due = dispatcher.due(pallets, now)
+            if due:
+                dispatcher.dispatch([Alert(to, subject, body_for(due), due)], now)
+    """
+    def __init__(self, name: str, cooldown_minutes: int=ALERT_COOLDOWN_MINUTES, store: Optional[state.StateStore]=None):
+        self.namespace = f"alerts:{name}"
+        self.cooldown = datetime.timedelta(minutes=cooldown_minutes)
+        self.store = store or state.StateStore()
+
+    def _sent(self) -> Dict[str, str]:
+        return self.store.get(self.namespace, 'sent', {})
+
+    def due(self, keys: Iterable[str], now: datetime.datetime) -> List[str]:
+        """
+            Returns the keys that haven't been alerted within the cooldown, in the order given.
+        """
+        sent = self._sent()
+        return [key for key in dict.fromkeys(keys)
+                if key not in sent or now - datetime.datetime.fromisoformat(sent[key]) >= self.cooldown]
+
+    def dispatch(self, alerts: List[Alert], now: datetime.datetime) -> int:
+        """
+            Sends the alerts and starts the cooldown of their keys. Alerts without recipients are skipped.
+
+                Returns:
+                    sent (int)  : The number of messages sent
+        """
+        alerts = [alert for alert in alerts if alert.to]
+        if not alerts:
+            return 0
+
+        sent_keys = []
+        try:
+            with Email() as email:
+                for alert in alerts:
+                    email.mail_attachments = []
+                    for path in alert.attachments:
+                        email.addAttachment(path)
+                    email.sendMessage(', '.join(alert.to), alert.subject, alert.body)
+                    sent_keys.extend(alert.keys)
+                    logging.info(f"Sent alert '{alert.subject}' to {len(alert.to)} recipients")
+        finally:
+            # alerts that went out before a failure still start their cooldown; expired keys are
+            # dropped so the state doesn't grow with every key ever alerted
+            sent = {key: at for key, at in self._sent().items() if now - datetime.datetime.fromisoformat(at) < self.cooldown}
+            sent.update({key: now.isoformat() for key in sent_keys})
+            self.store.put(self.namespace, {'sent': sent})
+        return len(alerts)
@@ -0,0 +1,121 @@
+import csv
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+
+class ReportCache():
+    """
+        Keeps the rows of recent report runs so repeated requests for the same report, columns,
+        filters and sort order within the TTL are answered without going back to Nulogy.
+
+        Entries live in memory, least recently used first out once max_cells (rows x columns) is exceeded. When a
+        directory is given, entries are also written there as gzipped CSV so they survive a worker
+        restart on the same instance.
+    """
+    def __init__(self, max_cells: int=2_000_000, directory: Optional[str]=None):
+        self.max_cells = max_cells
+        self.directory = directory
+        self._entries = OrderedDict()       # key -> (expires_at, rows)
+        self._cells = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(report_code: str, columns: List[str], filters: List[dict], sort_by: List[dict]) -> str:
+        request = json.dumps([report_code, columns, filters, sort_by], sort_keys=True)
+        return f"{report_code}-{hashlib.sha1(request.encode('utf-8')).hexdigest()}"
+
+    def get(self, key: str) -> Optional[List[List[str]]]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, rows = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return rows
+                self._remove(key)
+
+        rows = self._read_file(key, now)
+        with self._lock:
+            if rows is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return rows
+
+    def put(self, key: str, rows: List[List[str]], ttl: float) -> None:
+        expires_at = time.time() + ttl
+        with self._lock:
+            self._add(key, expires_at, rows)
+        self._write_file(key, rows, expires_at)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._cells = 0
+        if self.directory:
+            for name in os.listdir(self.directory):
+                if name.endswith('.csv.gz'):
+                    os.remove(os.path.join(self.directory, name))
+
+    def _add(self, key: str, expires_at: float, rows: List[List[str]]) -> None:
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (expires_at, rows)
+        self._cells += self._size(rows)
+        while self._cells > self.max_cells and len(self._entries) > 1:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str) -> None:
+        _, rows = self._entries.pop(key)
+        self._cells -= self._size(rows)
+
+    @staticmethod
+    def _size(rows: List[List[str]]) -> int:
+        return len(rows) * (len(rows[0]) if rows else 0)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.csv.gz")
+
+    def _write_file(self, key: str, rows: List[List[str]], expires_at: float) -> None:
+        if not self.directory:
+            return
+        path = self._path(key)
+        try:
+            with gzip.open(f"{path}.tmp", 'wt', encoding='utf-8', newline='') as file:
+                csv.writer(file).writerows(rows)
+            os.utime(f"{path}.tmp", (expires_at, expires_at))      # mtime doubles as the expiry time
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            logging.warning(f"Unable to write report cache file {path}: {e}")
+
+    def _read_file(self, key: str, now: float) -> Optional[List[List[str]]]:
+        if not self.directory:
+            return None
+        path = self._path(key)
+        try:
+            expires_at = os.path.getmtime(path)
+            if expires_at <= now:
+                os.remove(path)
+                return None
+            with gzip.open(path, 'rt', encoding='utf-8', newline='') as file:
+                rows = list(csv.reader(file))
+        except OSError:
+            return None
+
+        with self._lock:
+            self._add(key, expires_at, rows)
+        return rows
@@ -1,16 +1,90 @@
+import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
 from azure.identity import DefaultAzureCredential
 from azure.keyvault.secrets import SecretClient
 
-_credential = DefaultAzureCredential()
-
 _keyVaultName = 'Accu-tec-KV'
 _KVUri = f"https://{_keyVaultName}.vault.azure.net"
 
-_client = SecretClient(vault_url=_KVUri, credential=_credential)
+# Constant name -> Key Vault secret name. The constants are read as attributes of this module
+# (config.NULOGY_SECRET_KEY) and fetched on first access, so a function only waits for the secrets it uses.
+SECRETS = {
+    "NULOGY_SECRET_KEY"             : "NulogySecretKey",
+    "AZURE_DB_CONNECTION_STRING"    : "AzureDatabaseConnectionString",
+    "DAX_DB_CONNECTION_STRING"      : "DAX-DB-ConnectionString",
+    "SMTP_USERNAME"                 : "SMTP-Username",
+    "SMTP_PASSWORD"                 : "SMTP-Password",
+}
+
+# Seconds a fetched secret is used before it is fetched again, so rotated secrets are picked up by warm workers.
+SECRET_TTL = int(os.environ.get('SECRET_TTL_SECONDS', 60 * 60))
+
+_client = None
+_client_lock = threading.Lock()
+_secrets = {}               # constant name -> (expires_at, value)
+_secrets_lock = threading.Lock()
+
+def _get_client() -> SecretClient:
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = SecretClient(vault_url=_KVUri, credential=DefaultAzureCredential())
+        return _client
+
+def _get_secret(name: str, environment_variable: str) -> str:
+    # An environment variable of the same name as the constant takes precedence over Key Vault,
+    # which lets the functions run against local stand-ins (see benchmarks/).
+    if environment_variable in os.environ:
+        return os.environ[environment_variable]
+
+    return _get_client().get_secret(name).value
+
+def get_secrets(*names: str) -> Dict[str, str]:
+    """
+        Returns the named secrets, fetching the ones that aren't cached (or have expired) from Key Vault
+        at the same time. If a refresh fails, the expired value keeps being used until the next attempt.
+
+            Parameter:
+                names (str)     : Constant names from SECRETS, e.g. 'SMTP_USERNAME'
+
+            Returns:
+                secrets (dict)  : Constant name -> value
+    """
+    for name in names:
+        if name not in SECRETS:
+            raise Exception(f"Unknown secret {name}")
+
+    now = time.monotonic()
+    with _secrets_lock:
+        cached = {name: _secrets.get(name) for name in names}
+    missing = [name for name, entry in cached.items() if entry is None or entry[0] <= now]
+
+    if missing:
+        with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            futures = {name: executor.submit(_get_secret, SECRETS[name], name) for name in missing}
+
+        for name, future in futures.items():
+            try:
+                value = future.result()
+            except Exception as e:
+                if cached[name] is None:
+                    raise
+                logging.warning(f"Unable to refresh secret {name}, using the cached value: {e!r}")
+                continue
+            cached[name] = (now + SECRET_TTL, value)
+            with _secrets_lock:
+                _secrets[name] = cached[name]
+
+    return {name: cached[name][1] for name in names}
+
+def get_secret(name: str) -> str:
+    return get_secrets(name)[name]
 
-NULOGY_SECRET_KEY           = _client.get_secret("NulogySecretKey").value
-AZURE_DB_CONNECTION_STRING  = _client.get_secret("AzureDatabaseConnectionString").value
-DAX_DB_CONNECTION_STRING    = _client.get_secret("DAX-DB-ConnectionString").value
-SMTP_USERNAME               = _client.get_secret("SMTP-Username").value
-SMTP_PASSWORD               = _client.get_secret("SMTP-Password").value
+def __getattr__(name: str) -> str:
+    if name in SECRETS:
+        return get_secret(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
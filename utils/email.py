@@ -4,36 +4,95 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 from email import encoders
-from utils.config import SMTP_USERNAME, SMTP_PASSWORD
+from typing import Iterable, Union
+from utils import config
+
+# SMTP server settings; point them at a local stand-in (e.g. python -m aiosmtpd -n) with SMTP_STARTTLS=false for testing.
+SMTP_HOST = os.environ.get('SMTP_HOST', 'smtp.office365.com')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', 587))
+SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS', 'true').lower() not in ('0', 'false', 'no')
 
 class Email():
-    def __init__(self, username: str=SMTP_USERNAME, password: str=SMTP_PASSWORD, host: str='smtp.office365.com', port: int=587):
+    """
+        Sends one or more messages over a single SMTP session. The session is opened (and the credentials
+        fetched) when the first message is sent and stays open until close(), or the end of a with block.
+
+            with Email() as email:
+                email.sendMessage('a@example.com, b@example.com', 'Subject', '<p>Hello</p>')
+                email.sendMessage('c@example.com', 'Other subject', '<p>Hello again</p>')
+    """
+    def __init__(self, username: str=None, password: str=None, host: str=SMTP_HOST, port: int=SMTP_PORT,
+                 starttls: bool=SMTP_STARTTLS):
         self.username = username
         self.password = password
-        self.connection = smtplib.SMTP(host, port)
-        self.mimemsg = MIMEMultipart()
-        self.mimemsg['From'] = username
+        self.host = host
+        self.port = port
+        self.starttls = starttls
+        self.connection = None
         self.mail_attachments = []
 
-    def sendMessage(self, to: str, subject: str, body: str, cc: str=''):
-        self.mimemsg['To'] = to
-        self.mimemsg['Cc'] = cc
-        self.mimemsg['Subject'] = subject
-        self.mimemsg.attach(MIMEText(body, 'HTML'))
-
-        if self.mail_attachments:
-            for path, name in self.mail_attachments:
-                with open(path, 'rb') as attachment:
-                    mimefile = MIMEBase('application', 'octet-stream')
-                    mimefile.set_payload((attachment).read())
-                    encoders.encode_base64(mimefile)
-                    mimefile.add_header('Content-Disposition', f'attachment; filename={name}')
-                    self.mimemsg.attach(mimefile)
-
-        self.connection.starttls()
-        self.connection.login(self.username, self.password)
-        self.connection.send_message(self.mimemsg)
-        self.connection.quit()
+    def __enter__(self) -> 'Email':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    def _connect(self) -> smtplib.SMTP:
+        if self.connection is not None:
+            return self.connection
+
+        if self.username is None or self.password is None:
+            secrets = config.get_secrets('SMTP_USERNAME', 'SMTP_PASSWORD')
+            self.username = self.username if self.username is not None else secrets['SMTP_USERNAME']
+            self.password = self.password if self.password is not None else secrets['SMTP_PASSWORD']
+
+        connection = smtplib.SMTP(self.host, self.port)
+        try:
+            if self.starttls:
+                connection.starttls()
+            connection.ehlo_or_helo_if_needed()
+            if connection.has_extn('auth'):
+                connection.login(self.username, self.password)
+        except Exception:
+            connection.close()
+            raise
+        self.connection = connection
+        return connection
+
+    def close(self) -> None:
+        if self.connection is None:
+            return
+        try:
+            self.connection.quit()
+        except smtplib.SMTPException:
+            self.connection.close()
+        self.connection = None
+
+    def _attachment(self, path: str, name: str) -> MIMEBase:
+        with open(path, 'rb') as attachment:
+            mimefile = MIMEBase('application', 'octet-stream')
+            mimefile.set_payload(attachment.read())
+        encoders.encode_base64(mimefile)
+        mimefile.add_header('Content-Disposition', f'attachment; filename={name}')
+        return mimefile
+
+    def sendMessage(self, to: str, subject: str, body: Union[str, Iterable[str]], cc: str=''):
+        """
+            Sends a message with the attachments added so far. The body can be a string or the pieces of one.
+        """
+        mimemsg = MIMEMultipart()
+        mimemsg['From'] = self.username or ''
+        mimemsg['To'] = to
+        mimemsg['Cc'] = cc
+        mimemsg['Subject'] = subject
+        mimemsg.attach(MIMEText(body if isinstance(body, str) else ''.join(body), 'HTML'))
+
+        for path, name in self.mail_attachments:
+            mimemsg.attach(self._attachment(path, name))
+
+        connection = self._connect()
+        mimemsg.replace_header('From', self.username)
+        connection.send_message(mimemsg)
 
     def addAttachment(self, attachment_path: str):
         attachment_path = os.path.abspath(attachment_path)
@@ -41,7 +100,7 @@ class Email():
 
 
 if __name__ == '__main__':
-    email = Email()
-    email.addAttachment(r'C:\Users\erussell\Repositories\Nulogy-Export\output\item_cost_update.csv')
-    email.addAttachment(r'C:\Users\erussell\Repositories\Nulogy-Export\output\inventory_snapshot.csv')
-    email.sendMessage('erussell@ciservicesnow.com', 'This is just a test', 'Hello world!')
+    with Email() as email:
+        email.addAttachment(r'C:\Users\erussell\Repositories\Nulogy-Export\output\item_cost_update.csv')
+        email.addAttachment(r'C:\Users\erussell\Repositories\Nulogy-Export\output\inventory_snapshot.csv')
+        email.sendMessage('erussell@ciservicesnow.com', 'This is just a test', 'Hello world!')
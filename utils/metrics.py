@@ -0,0 +1,128 @@
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+from time import perf_counter
+from typing import Callable, Optional
+
+# Stage timings are only collected and logged when METRICS_ENABLED is set in the app settings.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '').lower() in ('1', 'true', 'yes')
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+def _log(path: str, seconds: float, attributes: dict) -> None:
+    entry = {"span": path, "seconds": round(seconds, 4), **attributes}
+    if "rows" in attributes and seconds > 0:
+        entry["rows_per_second"] = round(attributes["rows"] / seconds, 1)
+    logging.info(f"METRIC {json.dumps(entry, default=str)}")
+
+
+class Span():
+    """
+        Times one stage of a pipeline (e.g. a report download or a bulk insert) and logs it as a single
+        structured "METRIC {...}" line when the stage ends. Spans nest, so each line carries the path
+        of the stages it ran inside, and counters can be added to the innermost open span with count().
+    """
+    __slots__ = ('name', 'path', 'attributes', '_start', '_token')
+
+    def __init__(self, name: str, attributes: dict):
+        self.name = name
+        self.attributes = attributes
+        self.path = name
+        self._start = None
+        self._token = None
+
+    def __enter__(self) -> 'Span':
+        parent = _current_span.get()
+        if parent is not None:
+            self.path = f"{parent.path}/{self.name}"
+        self._token = _current_span.set(self)
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        seconds = perf_counter() - self._start
+        _current_span.reset(self._token)
+
+        attributes = self.attributes
+        if exc_type is not None:
+            attributes = {**attributes, "error": exc_type.__name__}
+        _log(self.path, seconds, attributes)
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def add(self, name: str, amount: float=1) -> None:
+        self.attributes[name] = self.attributes.get(name, 0) + amount
+
+
+class _NoopSpan():
+    __slots__ = ()
+
+    def __enter__(self) -> '_NoopSpan':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+    def set(self, **attributes) -> None:
+        pass
+
+    def add(self, name: str, amount: float=1) -> None:
+        pass
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name: str, **attributes):
+    """
+        Usage:
+            with metrics.span('sql.bulk_insert', table=table) as s:
+                ...
+                s.set(rows=total)
+    """
+    if not METRICS_ENABLED:
+        return _NOOP_SPAN
+    return Span(name, attributes)
+
+def record(name: str, seconds: float, **attributes) -> None:
+    """
+        Logs a stage that was timed by the caller. Use it where a with-block doesn't fit, such as a
+        generator that is consumed while other spans open and close.
+    """
+    if not METRICS_ENABLED:
+        return
+    parent: Optional[Span] = _current_span.get()
+    _log(name if parent is None else f"{parent.path}/{name}", seconds, attributes)
+
+def count(name: str, amount: float=1) -> None:
+    """
+        Adds to a counter on the innermost open span, e.g. the number of polls of a report run.
+    """
+    if not METRICS_ENABLED:
+        return
+    current: Optional[Span] = _current_span.get()
+    if current is not None:
+        current.add(name, amount)
+
+def timed(name: str) -> Callable:
+    """
+        Decorator that runs a whole function (sync or async) inside a span, e.g. a function entry point.
+    """
+    def decorator(function: Callable) -> Callable:
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
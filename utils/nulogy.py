@@ -1,60 +1,303 @@
-from utils.config import NULOGY_SECRET_KEY
-from typing import List, Dict
-from time import sleep
-from random import randint
+from utils.cache import ReportCache
+from utils import config, metrics
+from typing import List, Dict, Iterator, NamedTuple, Optional
+from time import sleep, monotonic, perf_counter
+from random import uniform
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 import datetime
+import threading
+import codecs
+import io
+import asyncio
+import os
+import aiohttp
+import numpy as np
+import pandas as pd
 import requests
 import json
 import csv
 import logging
 
 uoms = None
+uom_index = None
+_uom_factors = None
+_uoms_lock = threading.Lock()
+
+# Short unit codes that show up in reports, mapped to the long form used in the UOM ratios.
+UOM_SHORT_CODES = {
+    'ea'    : 'eaches',
+    'cs'    : 'cases',
+    'pl'    : 'pallets',
+    'rl'    : 'rolls',
+    'lbs'   : 'pounds',
+    'bdl'   : 'bundles',
+    'pk'    : 'packs',
+    'kg'    : 'kilograms',
+    'ltr'   : 'liters',
+    'box'   : 'boxes',
+    'gal'   : 'gallons',
+    'ft'    : 'feet'
+}
+
+# Maximum number of report runs this worker keeps in flight with Nulogy at the same time.
+MAX_CONCURRENT_REPORTS = int(os.environ.get('NULOGY_MAX_CONCURRENT_REPORTS', 6))
+_report_slots = threading.BoundedSemaphore(MAX_CONCURRENT_REPORTS)
+
+REPORTS_URL = os.environ.get('NULOGY_REPORTS_URL', "https://app.nulogy.net/api/reports/report_runs")
+
+# Keep-alive connection pools shared by every caller in the worker process, so polls and downloads
+# reuse open connections instead of paying a new TCP/TLS handshake per request.
+_session = requests.Session()
+_adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=MAX_CONCURRENT_REPORTS * 2)
+_session.mount('https://', _adapter)
+_session.mount('http://', _adapter)
+
+# aiohttp sessions are bound to the event loop they were created on, so keep one per loop.
+_async_sessions = {}
+
+class PollPolicy(NamedTuple):
+    """
+        How long to wait between status checks of a report run. The first wait is initial_delay
+        (or the report's usual run time once it is known), then each wait grows by factor up to
+        max_delay. Every wait is randomised by +/- jitter so concurrent runs don't poll in lockstep.
+    """
+    initial_delay   : float = 1.0
+    factor          : float = 2.0
+    max_delay       : float = 20.0
+    jitter          : float = 0.25
+
+DEFAULT_POLL_POLICY = PollPolicy()
+
+# Per report code overrides. Small lookup reports finish in a couple of seconds, large fact reports take minutes.
+POLL_POLICIES = {
+    "uom_ratios"        : PollPolicy(initial_delay=0.5, max_delay=5.0),
+    "item_master"       : PollPolicy(initial_delay=1.0, max_delay=10.0),
+    "pallet_aging"      : PollPolicy(initial_delay=0.5, max_delay=5.0),
+    "job_productivity"  : PollPolicy(initial_delay=0.5, max_delay=5.0),
+    "shipment_item"     : PollPolicy(initial_delay=5.0, max_delay=30.0),
+    "job_profitability" : PollPolicy(initial_delay=2.0, max_delay=30.0),
+}
+
+# Back-off between failed report submissions.
+SUBMIT_RETRY_POLICY = PollPolicy(initial_delay=5.0, factor=2.0, max_delay=120.0, jitter=0.5)
+
+# Smoothed time (in seconds) each report code takes from submission to completion in this worker.
+report_durations = {}
+_REPORT_DURATION_SMOOTHING = 0.3
+
+def record_report_duration(report_code: str, seconds: float) -> None:
+    previous = report_durations.get(report_code)
+    if previous is None:
+        report_durations[report_code] = seconds
+    else:
+        report_durations[report_code] = previous + _REPORT_DURATION_SMOOTHING * (seconds - previous)
+    logging.info(f"{report_code} report completed in {seconds:.1f}s (typical {report_durations[report_code]:.1f}s)")
+
+def poll_delays(report_code: Optional[str]=None, policy: Optional[PollPolicy]=None) -> Iterator[float]:
+    """
+        Yields the successive waits (in seconds) before each status check of a report run.
+    """
+    if policy is None:
+        policy = POLL_POLICIES.get(report_code, DEFAULT_POLL_POLICY)
+
+    delay = policy.initial_delay
+    typical = report_durations.get(report_code)
+    if typical is not None:
+        # Skip straight to the point where the report usually finishes.
+        delay = max(delay, min(typical, policy.max_delay))
+
+    while True:
+        yield min(policy.max_delay, delay * uniform(1 - policy.jitter, 1 + policy.jitter))
+        delay = min(policy.max_delay, delay * policy.factor)
+
+def retry_after(headers) -> Optional[float]:
+    """
+        Returns the wait requested by a Retry-After header in seconds, if there is one.
+    """
+    value = headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+# Seconds a report may be answered from cache, per report code and columns. Only the reference data that
+# several functions request each night (the UOM lookups) is listed; any other request, including other
+# column sets of the same reports, is always run.
+REPORT_CACHE_TTL = {
+    ("item_master", ("code", "base_unit_of_measure"))                                   : 6 * 60 * 60,
+    ("uom_ratios",  ("code", "unit_of_measure", "ratio", "conversion_unit_of_measure"))  : 24 * 60 * 60,
+}
+
+# Reports are kept in memory up to this many cells (rows x columns) in total and, if NULOGY_REPORT_CACHE_DIR
+# is set, written there compressed so a restarted worker on the same instance can reuse them.
+report_cache = ReportCache(max_cells=int(os.environ.get('NULOGY_REPORT_CACHE_MAX_CELLS', 2_000_000)),
+                           directory=os.environ.get('NULOGY_REPORT_CACHE_DIR'))
+
+# Attempts each shard of a sharded report gets before the whole report fails.
+SHARD_ATTEMPTS = int(os.environ.get('NULOGY_SHARD_ATTEMPTS', 3))
+
+# Format of the thresholds of a between filter.
+THRESHOLD_FORMAT = "%Y-%m-%d %H:%M"
+
 utc_timestamp = datetime.datetime.utcnow().replace(
         tzinfo=datetime.timezone.utc).isoformat()
 
+def cache_ttl(report_code: str, columns: List[str]) -> Optional[float]:
+    return REPORT_CACHE_TTL.get((report_code, tuple(columns)))
+
+def _auth_headers() -> dict:
+    return {
+        "Authorization": f"Basic {config.NULOGY_SECRET_KEY}",
+        "Content-Type": "application/json; charset=utf-8",
+        "Accept": "application/json"
+    }
+
+def _parse_report(report: str) -> Iterator[List[str]]:
+    report = csv.reader(io.StringIO(report, newline=''), delimiter=',', quotechar='"')
+    return (row for row in report if row)      # remove blank lines
+
+def _iter_lines(chunks: Iterator[bytes], encoding: str='utf-8') -> Iterator[str]:
+    """
+        Decodes a stream of byte chunks incrementally and yields complete lines with their line endings,
+        which is what csv.reader needs to keep quoted fields that contain newlines intact. Lines end at
+        a line feed only, not at the other separators str.splitlines knows (U+2028, form feed...), as they
+        do when the whole report is parsed at once.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ''
+    for chunk in chunks:
+        pending += decoder.decode(chunk)
+        # anything after the last \n is a partial line, keep it for the next chunk
+        end = pending.rfind('\n') + 1
+        if end:
+            lines, pending = pending[:end].split('\n'), pending[end:]
+            for line in lines[:-1]:
+                yield line + '\n'
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+def stream_report(download_url: str, chunk_size: int=64 * 1024) -> Iterator[List[str]]:
+    """
+        Downloads a report and yields its parsed rows as they arrive, so memory use does not grow
+        with the size of the report. The download stays open until the generator is exhausted or closed.
+    """
+    started_at = perf_counter()
+    rows = 0
+    downloaded = 0
+
+    def chunks(response):
+        nonlocal downloaded
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            downloaded += len(chunk)
+            yield chunk
+
+    with _session.get(download_url, stream=True) as response:
+        if response.status_code != 200:
+            logging.error(f'Error downloading report code {response.status_code}: {response.text}')
+            raise Exception(f"Invalid Status code downloading report: {response.status_code}")
+
+        lines = _iter_lines(chunks(response))
+        for row in csv.reader(lines, delimiter=',', quotechar='"'):
+            if row:
+                rows += 1
+                yield row
+
+    metrics.record('nulogy.download', perf_counter() - started_at, bytes=downloaded, rows=rows, streamed=True)
+
 def downlad_report(download_url: str) -> str:
 
-    response = requests.get(download_url)
+    with metrics.span('nulogy.download') as span:
+        response = _session.get(download_url)
 
-    if response.status_code != 200:
-        logging.error(f'Error downloading report code {response.status_code}: {response.text}')
-        raise Exception(f"Invalid Status code downloading report: {response.status_code}")
+        if response.status_code != 200:
+            logging.error(f'Error downloading report code {response.status_code}: {response.text}')
+            raise Exception(f"Invalid Status code downloading report: {response.status_code}")
+
+        span.set(bytes=len(response.content))
     
     return response.content.decode('utf-8')
 
 
-def poll_report_url(url: str) -> str:
+def poll_report_url(url: str, report_code: Optional[str]=None) -> str:
 
-    headers = {
-        "Authorization": f"Basic {NULOGY_SECRET_KEY}",
-        "Content-Type": "application/json; charset=utf-8",
-        "Accept": "application/json"
-    }
+    headers = _auth_headers()
+    delays = poll_delays(report_code)
 
-    response = requests.get(url=url, headers=headers)
+    wait = next(delays)
+    while True:
+        sleep(wait)
+        response = _session.get(url=url, headers=headers)
+        metrics.count('polls')
+        wait = next(delays)
 
-    if response.status_code != 200:
-        logging.error(f'Polling error code {response.status_code}: {response.text}')
-        raise Exception(f"Error in polling: {response.status_code}")
+        if response.status_code in (429, 503):
+            wait = retry_after(response.headers) or wait
+            logging.info(f"Polling throttled ({response.status_code}), waiting {wait:.1f} seconds before next poll")
+            continue
 
-    while response.json()['status'] != 'COMPLETED':
-        logging.info(f"Report status {response.json()['status']}, sleeping 10 seconds before next poll")
-        sleep(10)
-        response = requests.get(url=url, headers=headers)
-        if response.json()['status'] == 'FAILED':
-            logging.error(f"Report failed: {response.json()['status']}")
-            raise Exception(f"Report failed: {response.json()['status']}")
+        if response.status_code != 200:
+            logging.error(f'Polling error code {response.status_code}: {response.text}')
+            raise Exception(f"Error in polling: {response.status_code}")
 
-    return response.json()['url']
+        status = response.json()['status']
+        if status == 'COMPLETED':
+            return response.json()['url']
 
-def get_report(report_code: str, columns: List[str], filters: List[dict]=[], sort_by: List[dict]=[], headers: bool=True):
-    url = "https://app.nulogy.net/api/reports/report_runs"
+        if status == 'FAILED':
+            logging.error(f"Report failed: {status}")
+            raise Exception(f"Report failed: {status}")
 
-    _headers = {
-        "Authorization": f"Basic {NULOGY_SECRET_KEY}",
-        "Content-Type": "application/json; charset=utf-8",
-        "Accept": "application/json"
-    }
+        wait = retry_after(response.headers) or wait
+        logging.info(f"Report status {status}, sleeping {wait:.1f} seconds before next poll")
+
+def get_report(report_code: str, columns: List[str], filters: List[dict]=[], sort_by: List[dict]=[], headers: bool=True,
+               stream: bool=False, shards: int=1):
+    """
+        Runs a Nulogy report and returns an iterator over its rows.
+
+        With stream=True the report is downloaded and parsed while the rows are consumed instead of
+        being read into memory first. Use it for large reports that are processed row by row.
+
+        With shards > 1 the between filter is split into that many consecutive date ranges, which are
+        run as separate reports at the same time and returned as one report (see _run_sharded).
+
+        Report code and column sets listed in REPORT_CACHE_TTL are served from report_cache while fresh.
+    """
+    ttl = cache_ttl(report_code, columns)
+    if ttl:
+        key = report_cache.key(report_code, columns, filters, sort_by)
+        rows = report_cache.get(key)
+        if rows is None:
+            rows = list(_run_report(report_code, columns, filters, sort_by, stream=False))
+            report_cache.put(key, rows, ttl)
+        else:
+            logging.info(f"Using cached {report_code} report")
+        # callers are free to modify the rows they get, so hand out copies
+        report = (list(row) for row in rows)
+    elif shards > 1:
+        report = _run_sharded(report_code, columns, filters, sort_by, stream, shards)
+    else:
+        report = _run_report(report_code, columns, filters, sort_by, stream)
+
+    if not headers:
+        next(report)
+
+    return report
+
+def _run_report(report_code: str, columns: List[str], filters: List[dict], sort_by: List[dict], stream: bool):
+    url = REPORTS_URL
+
+    _headers = _auth_headers()
 
     _data = json.dumps({
         "report" : report_code,
@@ -63,36 +306,225 @@ def get_report(report_code: str, columns: List[str], filters: List[dict]=[], sor
         "sort_by": sort_by
     })
 
-    error_count = 0
+    with metrics.span('nulogy.report', report_code=report_code), _report_slots:
+        with metrics.span('nulogy.submit') as span:
+            error_count = 0
+            retry_delays = poll_delays(policy=SUBMIT_RETRY_POLICY)
+            while True:
+                logging.info(f"Submitting request for {report_code} report")
+                submitted_at = monotonic()
+                response = _session.post(url=url, headers=_headers, data=_data)
+                span.add('attempts')
+
+                if response.status_code == 201:
+                    break
+            
+                if response.status_code != 201:
+                    logging.error(f'Get report error {response.status_code}: {response.text}')
+                    if error_count > 3:
+                        logging.error(f'Too many failed attempts. Exiting')
+                        raise Exception
+                    error_count += 1
+                sleep(retry_after(response.headers) or next(retry_delays))
+
+        try:
+            status_url = response.json()['status_url']
+            with metrics.span('nulogy.queue_wait'):
+                result_url = poll_report_url(status_url, report_code)
+            record_report_duration(report_code, monotonic() - submitted_at)
+            if stream:
+                report = stream_report(result_url)
+            else:
+                report = downlad_report(result_url)
+                report = _parse_report(report)
+
+        except Exception as e:
+            logging.error(f'EXCEPTION-{report_code}-{utc_timestamp}: {e}')
+            raise
+    
+    return report
+
+def shard_filters(filters: List[dict], shards: int) -> List[List[dict]]:
+    """
+        Splits the between filter of a report request into consecutive, non-overlapping date ranges.
+        Thresholds are inclusive and minute precise, so each range ends the minute before the next one starts.
+
+            Parameter:
+                filters (list)  : The report filters, with exactly one between filter
+                shards (int)    : The number of ranges to split it into
+
+            Returns:
+                filters (list)  : One list of filters per range, in date order
+    """
+    between = [index for index, filter in enumerate(filters) if filter.get('operator') == 'between']
+    if len(between) != 1:
+        raise Exception(f"A sharded report needs exactly one between filter, got {len(between)}")
+    index = between[0]
+
+    start = datetime.datetime.strptime(filters[index]['from_threshold'], THRESHOLD_FORMAT)
+    end = datetime.datetime.strptime(filters[index]['to_threshold'], THRESHOLD_FORMAT)
+    minutes = int((end - start).total_seconds() // 60) + 1
+    shards = max(1, min(shards, minutes))
+
+    sharded = []
+    for shard in range(shards):
+        shard_start = start + datetime.timedelta(minutes=minutes * shard // shards)
+        shard_end = start + datetime.timedelta(minutes=minutes * (shard + 1) // shards - 1)
+        shard_filter = {**filters[index], 'from_threshold': shard_start.strftime(THRESHOLD_FORMAT),
+                                          'to_threshold': shard_end.strftime(THRESHOLD_FORMAT)}
+        sharded.append(filters[:index] + [shard_filter] + filters[index + 1:])
+    return sharded
+
+def _run_shard(report_code: str, columns: List[str], filters: List[dict], sort_by: List[dict], stream: bool):
+    delays = poll_delays(policy=SUBMIT_RETRY_POLICY)
+    for attempt in range(1, SHARD_ATTEMPTS + 1):
+        try:
+            return _run_report(report_code, columns, filters, sort_by, stream)
+        except Exception as e:
+            if attempt == SHARD_ATTEMPTS:
+                raise
+            wait = next(delays)
+            logging.warning(f"{report_code} shard {filters} failed ({e!r}), retrying in {wait:.1f} seconds")
+            sleep(wait)
+
+def _merge_shards(reports: List[Iterator[List[str]]]) -> Iterator[List[str]]:
+    header_sent = False
+    for report in reports:
+        header = next(report, None)
+        if header is not None and not header_sent:
+            header_sent = True
+            yield header
+        yield from report
+
+def _run_sharded(report_code: str, columns: List[str], filters: List[dict], sort_by: List[dict], stream: bool,
+                 shards: int) -> Iterator[List[str]]:
+    """
+        Runs each date range of the report as its own report run, up to MAX_CONCURRENT_REPORTS at a time,
+        so Nulogy generates them in parallel. A failed range is retried on its own up to SHARD_ATTEMPTS
+        times. Returns once every range has completed (and, unless streaming, downloaded), so a failure
+        is raised before the caller touches its tables; the rows come back in date order under one header.
+    """
+    sharded = shard_filters(filters, shards)
+    logging.info(f"Running {report_code} report as {len(sharded)} shards")
+
+    with metrics.span('nulogy.sharded_report', report_code=report_code, shards=len(sharded)), \
+         ThreadPoolExecutor(max_workers=min(len(sharded), MAX_CONCURRENT_REPORTS), thread_name_prefix='shard') as executor:
+        futures = [executor.submit(contextvars.copy_context().run, _run_shard, report_code, columns, shard, sort_by, stream)
+                   for shard in sharded]
+        try:
+            reports = [future.result() for future in futures]
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+
+    return _merge_shards(reports)
+
+def _get_async_session() -> aiohttp.ClientSession:
+    """
+    Returns the keep-alive session for the running event loop, creating it on first use.
+    """
+    loop = asyncio.get_running_loop()
+    session, _ = _async_sessions.get(loop, (None, None))
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_REPORTS * 2, keepalive_timeout=60)
+        session = aiohttp.ClientSession(connector=connector)
+        _async_sessions[loop] = (session, asyncio.Semaphore(MAX_CONCURRENT_REPORTS))
+    return session
+
+def _get_async_report_slots() -> asyncio.Semaphore:
+    _get_async_session()
+    return _async_sessions[asyncio.get_running_loop()][1]
+
+async def close_async_session() -> None:
+    """
+    Closes the shared session for the running event loop. Only needed when the loop is shutting down.
+    """
+    session, _ = _async_sessions.pop(asyncio.get_running_loop(), (None, None))
+    if session is not None:
+        await session.close()
+
+async def download_report_async(download_url: str) -> str:
+
+    async with _get_async_session().get(download_url) as response:
+        if response.status != 200:
+            text = await response.text()
+            logging.error(f'Error downloading report code {response.status}: {text}')
+            raise Exception(f"Invalid Status code downloading report: {response.status}")
+
+        return (await response.read()).decode('utf-8')
+
+async def poll_report_url_async(url: str, report_code: Optional[str]=None) -> str:
+
+    session = _get_async_session()
+    headers = _auth_headers()
+    delays = poll_delays(report_code)
+
+    wait = next(delays)
     while True:
-        logging.info(f"Submitting request for {report_code} report")
-        response = requests.post(url=url, headers=_headers, data=_data)
-
-        if response.status_code == 201:
-            break
-        
-        if response.status_code != 201:
-            logging.error(f'Get report error {response.status_code}: {response.text}')
-            if error_count > 3:
-                logging.error(f'Too many failed attempts. Exiting')
-                raise Exception
-            error_count += 1
-        sleep(randint(60,120))
-
-    # small sleep to give the report a chance to generate before polling for a download link
-    sleep(15)
+        await asyncio.sleep(wait)
+        wait = next(delays)
 
-    try:
-        status_url = response.json()['status_url']
-        result_url = poll_report_url(status_url)
-        report = downlad_report(result_url)
-        report = [line for line in report.split('\n') if line]      # remove blank lines
+        async with session.get(url=url, headers=headers) as response:
+            if response.status in (429, 503):
+                wait = retry_after(response.headers) or wait
+                logging.info(f"Polling throttled ({response.status}), waiting {wait:.1f} seconds before next poll")
+                continue
 
-        report = csv.reader(report, delimiter=',', quotechar='"')
+            if response.status != 200:
+                text = await response.text()
+                logging.error(f'Polling error code {response.status}: {text}')
+                raise Exception(f"Error in polling: {response.status}")
+            status = await response.json()
+            wait = retry_after(response.headers) or wait
+
+        if status['status'] == 'COMPLETED':
+            return status['url']
+
+        if status['status'] == 'FAILED':
+            logging.error(f"Report failed: {status['status']}")
+            raise Exception(f"Report failed: {status['status']}")
+
+        logging.info(f"Report status {status['status']}, sleeping {wait:.1f} seconds before next poll")
+
+async def get_report_async(report_code: str, columns: List[str], filters: List[dict]=[], sort_by: List[dict]=[], headers: bool=True):
+    """
+    Async version of get_report. Many reports can be awaited at once (e.g. with asyncio.gather)
+    and all of them share one pooled connection to Nulogy.
+    """
+    session = _get_async_session()
+
+    _data = json.dumps({
+        "report" : report_code,
+        "columns" : columns,
+        "filters": filters,
+        "sort_by": sort_by
+    })
+
+    async with _get_async_report_slots():
+        error_count = 0
+        retry_delays = poll_delays(policy=SUBMIT_RETRY_POLICY)
+        while True:
+            logging.info(f"Submitting request for {report_code} report")
+            submitted_at = monotonic()
+            async with session.post(url=REPORTS_URL, headers=_auth_headers(), data=_data) as response:
+                if response.status == 201:
+                    submitted = await response.json()
+                    break
+
+                text = await response.text()
+                logging.error(f'Get report error {response.status}: {text}')
+                if error_count > 3:
+                    logging.error(f'Too many failed attempts. Exiting')
+                    raise Exception(f"Unable to submit {report_code} report: {response.status}")
+                error_count += 1
+                wait = retry_after(response.headers) or next(retry_delays)
+            await asyncio.sleep(wait)
+
+        result_url = await poll_report_url_async(submitted['status_url'], report_code)
+        record_report_duration(report_code, monotonic() - submitted_at)
+        report = _parse_report(await download_report_async(result_url))
 
-    except Exception as e:
-        logging.error(f'EXCEPTION-{report_code}-{utc_timestamp}: {e}')
-    
     if not headers:
         next(report)
 
@@ -137,6 +569,60 @@ def get_uom_list() -> Dict:
             }
     return uoms
 
+def build_uom_index(uoms: Dict) -> Dict[str, Dict[str, float]]:
+    """
+        Compiles the output of get_uom_list into {item_code: {unit_of_measure: factor}}, where factor
+        converts one unit straight to the item's base unit. Conversion chains are followed once here
+        instead of on every conversion; units whose chain loops or never reaches the base unit are left out.
+    """
+    index = {}
+    for item_code, item in uoms.items():
+        base_unit = item.get("base_unit")
+        if base_unit is None:
+            continue
+
+        # first conversion listed for a unit wins, as it always has
+        edges = {}
+        for conversion in item["conversions"]:
+            from_unit = UOM_SHORT_CODES.get(conversion["from_unit"], conversion["from_unit"])
+            to_unit = UOM_SHORT_CODES.get(conversion["to_unit"], conversion["to_unit"])
+            edges.setdefault(from_unit, (to_unit, conversion["factor"]))
+
+        factors = {base_unit: 1.0}
+        for unit in edges:
+            path = []
+            factor = None
+            while unit not in factors:
+                if unit in path or unit not in edges:
+                    break
+                path.append(unit)
+                unit, step = edges[unit]
+            else:
+                factor = factors[unit]
+
+            # walk back along the chain so every unit on it is resolved in one pass
+            for unit in reversed(path):
+                if factor is not None:
+                    factor = factor * edges[unit][1]
+                factors[unit] = factor
+
+        index[item_code] = {unit: factor for unit, factor in factors.items() if factor is not None}
+    return index
+
+def _load_uom_index() -> Dict[str, Dict[str, float]]:
+    global uoms, uom_index, _uom_factors
+    if uom_index is None:
+        with _uoms_lock:
+            if uom_index is None:
+                if uoms is None:
+                    uoms = get_uom_list()
+                index = build_uom_index(uoms)
+                _uom_factors = pd.Series({(item_code, unit): factor
+                                          for item_code, factors in index.items()
+                                          for unit, factor in factors.items()}, dtype='float64')
+                uom_index = index
+    return uom_index
+
 def convertToBaseUnits(item_code: str, unit_of_measure: str, number_of_units: float) -> float:
     """
         Returns the number of base units for a specified item.
@@ -149,48 +635,45 @@ def convertToBaseUnits(item_code: str, unit_of_measure: str, number_of_units: fl
             Returns:
                 number_of_units (float) : The number of base units 
     """
-
-    short_to_long_uom = {
-        'ea'    : 'eaches',
-        'cs'    : 'cases',
-        'pl'    : 'pallets',
-        'rl'    : 'rolls',
-        'lbs'   : 'pounds',
-        'bdl'   : 'bundles',
-        'pk'    : 'packs',
-        'kg'    : 'kilograms',
-        'ltr'   : 'liters',
-        'box'   : 'boxes',
-        'gal'   : 'gallons',
-        'ft'    : 'feet'
-    }
-    
-    global uoms
-    if uoms == None:
-        uoms = get_uom_list()
+    index = _load_uom_index()
 
     # if a short code UOM is supplied convert it over to the long form
-    if unit_of_measure in short_to_long_uom:
-        unit_of_measure = short_to_long_uom[unit_of_measure]
+    unit_of_measure = UOM_SHORT_CODES.get(unit_of_measure, unit_of_measure)
 
     # if the number of units wasn't in a numeric type convert it
     if not isinstance(number_of_units, float):
         number_of_units = float(number_of_units)
 
-    item_base_unit = uoms[item_code]["base_unit"]
-    if unit_of_measure == item_base_unit:
-        return number_of_units
-
-    for conversion in uoms[item_code]["conversions"]:
-        if conversion["from_unit"] == unit_of_measure:
-            number_of_units = number_of_units * conversion["factor"]
-            unit_of_measure = conversion["to_unit"]
-            break
-    else:
+    try:
+        return number_of_units * index[item_code][unit_of_measure]
+    except KeyError:
         raise Exception(f"Unable to find {unit_of_measure} in {item_code} conversions.")
 
-    return convertToBaseUnits(item_code, unit_of_measure, number_of_units)
+def convert_to_base_units(item_codes, units_of_measure, numbers_of_units, errors: str='raise') -> pd.Series:
+    """
+        Vectorized convertToBaseUnits for whole columns (lists, arrays or Series of equal length).
 
+        Every row is converted with one lookup and one multiply. Rows that can't be converted are
+        collected together: with errors='raise' one exception lists all of them, with errors='coerce'
+        they are logged and returned as NaN.
+    """
+    _load_uom_index()
+
+    units_of_measure = pd.Series(units_of_measure, dtype='object').replace(UOM_SHORT_CODES)
+    keys = pd.MultiIndex.from_arrays([pd.Series(item_codes, dtype='object'), units_of_measure])
+    factors = _uom_factors.reindex(keys).to_numpy()
+    quantities = pd.to_numeric(pd.Series(numbers_of_units), errors='coerce').to_numpy(dtype='float64')
+
+    unconvertible = np.isnan(factors)
+    if unconvertible.any():
+        missing = sorted(set(keys[unconvertible]))
+        message = f"Unable to convert {int(unconvertible.sum())} rows to base units, missing conversions: {missing}"
+        if errors == 'raise':
+            raise Exception(message)
+        logging.warning(message)
+
+    index = numbers_of_units.index if isinstance(numbers_of_units, pd.Series) else None
+    return pd.Series(quantities * factors, index=index)
 
 if __name__ == '__main__':
 
@@ -0,0 +1,153 @@
+import contextvars
+import logging
+import os
+import queue
+import threading
+from itertools import chain, islice
+from time import monotonic
+from typing import Any, Callable, Iterable, Iterator, List, Sequence
+from utils import metrics, sql
+
+# Rows per batch passed between the stages of a pipeline.
+PIPELINE_BATCH_SIZE = int(os.environ.get('PIPELINE_BATCH_SIZE', 5000))
+
+# Batches that can wait between two stages. A stage that gets this far ahead of the next one blocks,
+# so at most about (stages + 1) * (PIPELINE_QUEUE_SIZE + 1) batches are in memory at once.
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', 4))
+
+_DONE = object()
+_POLL_SECONDS = 0.1
+
+
+class _Stopped(Exception):
+    pass
+
+
+def batches(rows: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+def _put(out: queue.Queue, item: Any, stop: threading.Event) -> None:
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=_POLL_SECONDS)
+            return
+        except queue.Full:
+            pass
+    raise _Stopped()
+
+def _drain(source: queue.Queue, stop: threading.Event) -> Iterator[Any]:
+    while True:
+        try:
+            item = source.get(timeout=_POLL_SECONDS)
+        except queue.Empty:
+            if stop.is_set():
+                raise _Stopped()
+            continue
+        if item is _DONE:
+            return
+        yield item
+
+def _worker(batches: Iterator[Any], stage: Callable[[Any], Any], out: queue.Queue, stop: threading.Event, errors: list) -> None:
+    try:
+        for batch in batches:
+            _put(out, batch if stage is None else stage(batch), stop)
+        _put(out, _DONE, stop)
+    except _Stopped:
+        pass
+    except BaseException as e:
+        errors.append(e)
+        stop.set()
+
+def run(source: Iterable[Any], sink: Callable[[Iterator[Any]], Any], stages: Sequence[Callable[[Any], Any]]=(),
+        batch_size: int=PIPELINE_BATCH_SIZE, queue_size: int=PIPELINE_QUEUE_SIZE, name: str='pipeline') -> Any:
+    """
+        Streams rows from a source through transform stages into a sink with bounded memory.
+
+        The source rows are grouped into batches of batch_size. Reading the source and every stage run on
+        their own threads, connected by queues of at most queue_size batches, so downloading and parsing a
+        report overlap with writing it; when the sink falls behind, the stages before it wait instead of
+        buffering the whole report. A failure anywhere stops every stage and is raised here.
+
+            Parameter:
+                source (iterable)   : Rows, e.g. a streamed report without its header row
+                sink (callable)     : Called once, on this thread, with an iterator over the final batches
+                stages (list)       : Functions from one batch (a list of rows or a DataFrame) to the next
+                batch_size (int)    : Rows per batch
+                queue_size (int)    : Batches that can wait between two stages
+
+            Returns:
+                The sink's return value, e.g. the number of rows written
+
+        Usage:
+            pipeline.run(report, pipeline.replace_sink('factLabor', headers, where))
+    """
+    stop = threading.Event()
+    errors = []
+    rows = 0
+
+    def counted(batches: Iterator[List[Any]]) -> Iterator[List[Any]]:
+        nonlocal rows
+        for batch in batches:
+            rows += len(batch)
+            yield batch
+
+    threads = []
+    upstream = counted(batches(source, batch_size))
+    for stage in [None, *stages]:
+        out = queue.Queue(maxsize=queue_size)
+        thread = threading.Thread(target=contextvars.copy_context().run, name=f"{name}-{len(threads)}",
+                                  args=(_worker, upstream, stage, out, stop, errors), daemon=True)
+        threads.append(thread)
+        upstream = _drain(out, stop)
+
+    start = monotonic()
+    with metrics.span('pipeline', pipeline=name, stages=len(stages)) as span:
+        for thread in threads:
+            thread.start()
+        try:
+            result = sink(upstream)
+        except _Stopped:
+            result = None
+        finally:
+            stop.set()      # a sink that stopped reading early must not leave the stages blocked
+            for thread in threads:
+                thread.join()
+        span.set(rows=rows)
+
+    if errors:
+        raise errors[0]
+
+    elapsed = monotonic() - start
+    logging.info(f"{name}: streamed {rows} rows through {len(stages)} stages in {elapsed:.1f}s")
+    return result
+
+def insert_sink(table: str, columns: Sequence[str]) -> Callable[[Iterator[List[Sequence]]], int]:
+    """
+        Sink that appends batches of rows to a table with sql.bulk_insert, over one connection.
+    """
+    return lambda batches: sql.bulk_insert(table=table, columns=columns, rows=chain.from_iterable(batches))
+
+def replace_sink(table: str, columns: Sequence[str], where: str) -> Callable[[Iterator[List[Sequence]]], int]:
+    """
+        Sink that replaces the rows of a table matching where with the batches, using sql.bulk_replace.
+        Nothing is deleted until every batch has been staged, so a failed run leaves the table as it was.
+    """
+    return lambda batches: sql.bulk_replace(table=table, columns=columns, rows=chain.from_iterable(batches), where=where)
+
+def upsert_sink(table: str, key: Sequence[str], columns: Sequence[str]) -> Callable[[Iterator[List[Sequence]]], tuple]:
+    """
+        Sink that merges batches of rows into a table on the key columns with sql.bulk_upsert.
+    """
+    return lambda batches: sql.bulk_upsert(table=table, key=key, columns=columns, rows=chain.from_iterable(batches))
+
+def frame_sink(table: str) -> Callable[[Iterator[Any]], int]:
+    """
+        Sink that appends batches that are DataFrames to a table with sql.write_frames, which writes the
+        chunks of consecutive batches in parallel.
+    """
+    return lambda frames: sql.write_frames(frames, table)
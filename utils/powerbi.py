@@ -0,0 +1,153 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+from time import monotonic, sleep
+from typing import Dict, List, NamedTuple, Optional, Sequence
+import requests
+from utils import metrics
+from utils.nulogy import PollPolicy, poll_delays, retry_after
+
+# Power BI push datasets accept at most 10,000 rows per request; payloads are also kept under a size limit.
+PUSH_MAX_ROWS = int(os.environ.get('POWERBI_PUSH_MAX_ROWS', 10_000))
+PUSH_MAX_BYTES = int(os.environ.get('POWERBI_PUSH_MAX_BYTES', 4 * 2**20))
+
+# Payloads are sent gzip compressed unless POWERBI_GZIP is false. An endpoint that rejects compressed
+# payloads is remembered and sent plain JSON from then on.
+PUSH_GZIP = os.environ.get('POWERBI_GZIP', 'true').lower() not in ('0', 'false', 'no')
+
+# Attempts per chunk and the back-off between them, for throttling (429), server errors and dropped connections.
+PUSH_ATTEMPTS = int(os.environ.get('POWERBI_PUSH_ATTEMPTS', 4))
+PUSH_RETRY_POLICY = PollPolicy(initial_delay=1.0, factor=2.0, max_delay=30.0, jitter=0.25)
+
+# In delta mode, a full push is still sent when nothing has been pushed for this long, so tiles don't look stale.
+PUSH_HEARTBEAT_SECONDS = int(os.environ.get('POWERBI_HEARTBEAT_MINUTES', 60)) * 60
+
+_session = requests.Session()
+_adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=4)
+_session.mount('https://', _adapter)
+_session.mount('http://', _adapter)
+
+class _LastPush(NamedTuple):
+    payload     : str
+    rows        : frozenset
+    pushed_at   : float
+
+# Push URL -> what was last pushed to it by this worker, for delta mode.
+_last_pushes: Dict[str, _LastPush] = {}
+_plain_urls = set()
+_lock = threading.Lock()
+
+
+def row_hash(row: dict, ignore: Sequence[str]=()) -> str:
+    values = {key: value for key, value in row.items() if key not in ignore}
+    return hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def _chunks(rows: List[dict]) -> List[bytes]:
+    """
+        Serializes rows into JSON array payloads of at most PUSH_MAX_ROWS rows and about PUSH_MAX_BYTES each.
+    """
+    chunks = []
+    chunk, size = [], 2
+    for row in rows:
+        encoded = json.dumps(row, default=str)
+        if chunk and (len(chunk) >= PUSH_MAX_ROWS or size + len(encoded) + 1 > PUSH_MAX_BYTES):
+            chunks.append(f"[{','.join(chunk)}]".encode('utf-8'))
+            chunk, size = [], 2
+        chunk.append(encoded)
+        size += len(encoded) + 1
+    if chunk:
+        chunks.append(f"[{','.join(chunk)}]".encode('utf-8'))
+    return chunks
+
+def _post(url: str, body: bytes) -> requests.Response:
+    delays = poll_delays(policy=PUSH_RETRY_POLICY)
+    for attempt in range(1, PUSH_ATTEMPTS + 1):
+        with _lock:
+            compress = PUSH_GZIP and url not in _plain_urls
+
+        headers = {"Content-Type": "application/json"}
+        data = body
+        if compress:
+            headers["Content-Encoding"] = "gzip"
+            data = gzip.compress(body, compresslevel=5)
+
+        try:
+            response = _session.post(url=url, headers=headers, data=data)
+        except requests.ConnectionError as e:
+            response = None
+            logging.warning(f"Push to PowerBI failed: {e!r}")
+
+        if response is not None:
+            if response.ok:
+                metrics.count('bytes', len(data))
+                return response
+
+            if compress and response.status_code in (400, 415):
+                logging.warning(f"PowerBI rejected a compressed push ({response.status_code}), sending uncompressed from now on")
+                with _lock:
+                    _plain_urls.add(url)
+                continue
+
+            if response.status_code != 429 and response.status_code < 500:
+                logging.error(f'Push to PowerBI error {response.status_code}: {response.text}')
+                raise Exception(f"Push to PowerBI failed: {response.status_code}")
+
+        if attempt == PUSH_ATTEMPTS:
+            break
+        wait = (retry_after(response.headers) if response is not None else None) or next(delays)
+        logging.info(f"Push to PowerBI will be retried in {wait:.1f} seconds")
+        sleep(wait)
+
+    raise Exception(f"Push to PowerBI failed after {PUSH_ATTEMPTS} attempts")
+
+def push_rows(url: str, rows: List[dict], delta: Optional[str]=None, ignore: Sequence[str]=('timestamp',)) -> int:
+    """
+        Pushes rows to a Power BI push dataset over a persistent connection, compressed and split into
+        chunks that fit the dataset limits. Failed chunks are retried with back-off.
+
+            Parameter:
+                url (str)       : The dataset push URL
+                rows (list)     : Rows as dicts of column -> value
+                delta (str)     : None pushes every row; 'payload' skips the push when the rows are the same as
+                                  last time; 'rows' pushes only rows that weren't in the last push
+                ignore (list)   : Columns left out when comparing rows, e.g. the push timestamp
+
+            Returns:
+                pushed (int)    : The number of rows sent
+    """
+    if delta not in (None, 'payload', 'rows'):
+        raise Exception(f"Unknown delta mode {delta}")
+
+    hashes = [row_hash(row, ignore) for row in rows]
+    payload = hashlib.sha1(''.join(sorted(hashes)).encode('ascii')).hexdigest()
+    now = monotonic()
+
+    with _lock:
+        last = _last_pushes.get(url)
+    stale = last is None or now - last.pushed_at >= PUSH_HEARTBEAT_SECONDS
+
+    with metrics.span('powerbi.push', delta=delta) as span:
+        if delta and not stale and payload == last.payload:
+            logging.info(f"PowerBI push skipped, {len(rows)} rows unchanged")
+            span.set(rows=0, skipped=len(rows))
+            return 0
+
+        if delta == 'rows' and not stale:
+            changed = [row for row, hash in zip(rows, hashes) if hash not in last.rows]
+        else:
+            changed = rows
+
+        chunks = _chunks(changed)
+        for chunk in chunks:
+            response = _post(url, chunk)
+        span.set(rows=len(changed), skipped=len(rows) - len(changed), chunks=len(chunks))
+
+    with _lock:
+        _last_pushes[url] = _LastPush(payload, frozenset(hashes), now)
+
+    logging.info(f"Pushed {len(changed)} of {len(rows)} rows to PowerBI in {len(chunks)} requests"
+                 + (f", status code {response.status_code}" if chunks else ""))
+    return len(changed)
@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+from typing import Dict, Iterator, List
+from utils import metrics
+
+# Column types per report code, keyed by the API column code used when requesting the report.
+#   decimal / int       numbers, blanks become NaN / <NA>
+#   percent             "85.5%" -> 85.5
+#   bool                true/false, yes/no, 1/0
+#   category            repeated strings (lines, leaders, units...) stored once per distinct value
+#   datetime:<format>   parsed with the given strptime format
+# Columns that aren't listed stay as strings. Blank or whitespace-only values become NaN in every column.
+SCHEMAS = {
+    "job_profitability": {
+        "actual_job_start_at"       : "datetime:%Y-%b-%d %I:%M %p",
+        "invoiced"                  : "bool",
+    },
+    "job_productivity": {
+        "line_name"                 : "category",
+        "line_leader_name"          : "category",
+        "project_customer"          : "category",
+        "unit_of_measure"           : "category",
+        "actual_job_start_at"       : "datetime:%Y-%b-%d %I:%M %p",
+        "units_expected"            : "decimal",
+        "units_produced"            : "decimal",
+        "units_remaining"           : "decimal",
+        "pallets_produced"          : "decimal",
+        "standard_people"           : "decimal",
+        "number_of_personnel"       : "decimal",
+        "actual_person_hours"       : "decimal",
+        "performance"               : "percent",
+        "availability"              : "percent",
+        "line_efficiency"           : "percent",
+        "percent_complete"          : "percent",
+    },
+    "pallet_aging": {
+        "location"                  : "category",
+        "item_code"                 : "category",
+        "time_in_storage_minutes"   : "int",
+        "full_pallet_quantity"      : "decimal",
+    },
+    "item_master": {},
+}
+
+_TRUE = {"true", "yes", "y", "1"}
+_FALSE = {"false", "no", "n", "0"}
+
+
+def _parse_column(values: pd.Series, column_type: str) -> pd.Series:
+    if column_type == "decimal":
+        return pd.to_numeric(values.str.replace(',', '', regex=False), errors='coerce')
+
+    if column_type == "int":
+        return pd.to_numeric(values.str.replace(',', '', regex=False), errors='coerce').round().astype('Int64')
+
+    if column_type == "percent":
+        return pd.to_numeric(values.str.rstrip('%').str.replace(',', '', regex=False), errors='coerce')
+
+    if column_type == "bool":
+        lowered = values.str.strip().str.lower()
+        parsed = pd.Series(pd.NA, index=values.index, dtype='boolean')
+        parsed[lowered.isin(_TRUE)] = True
+        parsed[lowered.isin(_FALSE)] = False
+        return parsed
+
+    if column_type == "category":
+        return values.astype('category')
+
+    if column_type.startswith("datetime:"):
+        return pd.to_datetime(values, format=column_type[len("datetime:"):], errors='coerce')
+
+    raise Exception(f"Unknown column type {column_type}")
+
+def parse_report(report_code: str, columns: List[str], report: Iterator[List[str]], rename: bool=False) -> pd.DataFrame:
+    """
+        Builds a typed DataFrame from a report returned by get_report (with headers) using SCHEMAS.
+
+        Every column is converted in one vectorized pass instead of per cell. Nulogy names the columns
+        in the header row and some reports add leading ID columns that weren't requested, so the
+        requested columns are matched to the last len(columns) header columns.
+
+            Parameter:
+                report_code (str)   : The Nulogy report code, selects the schema
+                columns (list)      : The column codes the report was requested with
+                report (iterator)   : Report rows, header row first
+                rename (bool)       : Name the requested columns by their codes instead of Nulogy's headers
+
+            Returns:
+                df (DataFrame)      : The typed report
+    """
+    with metrics.span('parse', report_code=report_code) as span:
+        header = next(report)
+        df = pd.DataFrame.from_records(report, columns=header)
+
+        offset = len(header) - len(columns)
+        names: Dict[str, str] = {header[offset + i]: column for i, column in enumerate(columns)}
+
+        # blank values are missing values, whatever the column type
+        for name in df.columns:
+            values = df[name]
+            df[name] = values.where(values.str.strip() != '', np.nan)
+
+        schema = SCHEMAS.get(report_code, {})
+        for name, column in names.items():
+            if column in schema:
+                df[name] = _parse_column(df[name], schema[column])
+
+        if rename:
+            df = df.rename(columns=names)
+        span.set(rows=len(df), columns=len(df.columns))
+
+    return df
@@ -1,47 +1,125 @@
-import pyodbc 
 import logging
+import os
+import threading
+import uuid
+import pandas as pd
 import sqlalchemy
-from typing import List
-from utils.config import AZURE_DB_CONNECTION_STRING
-
-engine = sqlalchemy.create_engine("mssql+pyodbc:///?odbc_connect=%s" % AZURE_DB_CONNECTION_STRING)
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+from time import monotonic
+from typing import List, Iterable, Iterator, Sequence, Tuple
+from utils import config, metrics
+
+# Number of rows sent per executemany call / transaction by bulk_insert.
+BULK_BATCH_SIZE = int(os.environ.get('SQL_BULK_BATCH_SIZE', 5000))
+
+# Number of connections write_frame uses at once for large DataFrames.
+SQL_WRITE_WORKERS = int(os.environ.get('SQL_WRITE_WORKERS', 4))
+
+# Size of the connection pool shared by the helpers below and by pandas (to_sql / read_sql through engine).
+SQL_POOL_SIZE = int(os.environ.get('SQL_POOL_SIZE', 10))
+SQL_POOL_MAX_OVERFLOW = int(os.environ.get('SQL_POOL_MAX_OVERFLOW', 5))
+
+# The engine is created on first use (sql.engine or any helper below) rather than at import, so
+# functions that never touch the database don't wait for its connection string. It is rebuilt when
+# the connection string secret changes after its TTL (see config.SECRET_TTL).
+_engine = None
+_engine_connection_string = None
+_engine_lock = threading.Lock()
+
+# Connections physically opened vs. handed out by the pool, so reuse can be checked in the logs.
+pool_stats = {"opened": 0, "checkouts": 0}
+_pool_stats_lock = threading.Lock()
+
+def _count_connect(dbapi_connection, connection_record) -> None:
+    with _pool_stats_lock:
+        pool_stats["opened"] += 1
+
+def _count_checkout(dbapi_connection, connection_record, connection_proxy) -> None:
+    with _pool_stats_lock:
+        pool_stats["checkouts"] += 1
+
+def get_engine() -> sqlalchemy.engine.Engine:
+    global _engine, _engine_connection_string
+    connection_string = config.AZURE_DB_CONNECTION_STRING
+    with _engine_lock:
+        if _engine is not None and connection_string != _engine_connection_string:
+            # pooled connections are closed now, connections in use are closed when they are returned
+            logging.info("Database connection string changed, rebuilding the engine")
+            _engine.dispose()
+            _engine = None
+        if _engine is None:
+            _engine_connection_string = connection_string
+            _engine = sqlalchemy.create_engine("mssql+pyodbc:///?odbc_connect=%s" % connection_string,
+                                               pool_size=SQL_POOL_SIZE,
+                                               max_overflow=SQL_POOL_MAX_OVERFLOW,
+                                               pool_pre_ping=True,
+                                               pool_recycle=1800,
+                                               fast_executemany=True)
+            sqlalchemy.event.listen(_engine, "connect", _count_connect)
+            sqlalchemy.event.listen(_engine, "checkout", _count_checkout)
+        return _engine
+
+def __getattr__(name: str):
+    if name == 'engine':
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def get_pool_stats() -> dict:
+    with _pool_stats_lock:
+        return {
+            "opened"    : pool_stats["opened"],
+            "reused"    : pool_stats["checkouts"] - pool_stats["opened"],
+            "checked_out": _engine.pool.checkedout() if _engine is not None else 0,
+        }
+
+@contextmanager
+def connection():
+    """
+        Borrows a pyodbc connection from the shared pool and returns it when done.
+        Anything not committed is rolled back when the connection goes back to the pool.
+    """
+    cnxn = get_engine().raw_connection()
+    try:
+        yield cnxn
+    finally:
+        cnxn.close()
 
 def query(query: str) -> List[tuple]:
 
-    cnxn = pyodbc.connect(AZURE_DB_CONNECTION_STRING)
-    cursor = cnxn.cursor()
+    with connection() as cnxn:
+        cursor = cnxn.cursor()
 
-    cursor.execute(query)
+        cursor.execute(query)
 
-    result = cursor.fetchall()
-    cnxn.close()
+        result = cursor.fetchall()
 
     return result
 
 def insert(table: str, record: dict) -> None:
 
-    cnxn = pyodbc.connect(AZURE_DB_CONNECTION_STRING)
-    cursor = cnxn.cursor()
-
     record = clean_text(record)
 
     statement = f"""INSERT INTO {table} ({', '.join([f"[{column}]" for column in record.keys()])}) 
       VALUES ({', '.join([f"'{value}'" for value in record.values()])})"""
 
-    try:
-        cursor.execute(statement)
-        cursor.commit()
-    except Exception as e:
-        logging.critical(e)
-        logging.critical(statement)
+    with connection() as cnxn:
+        cursor = cnxn.cursor()
 
-    cnxn.close()
+        try:
+            cursor.execute(statement)
+            cursor.commit()
+        except Exception as e:
+            logging.critical(e)
+            logging.critical(statement)
 
 def insert_or_update(table: str, key: List[str], record: dict) -> None:
 
     record = clean_text(record)
 
-    with pyodbc.connect(AZURE_DB_CONNECTION_STRING) as cnxn:
+    with connection() as cnxn:
         cursor = cnxn.cursor()
         statement = f"""\
 begin tran
@@ -59,48 +137,317 @@ commit tran
 
         try:
             cursor.execute(statement)
+            cursor.commit()
         except:
             logging.error(statement)
 
 def drop_record(table: str, key: str, value: str) -> None:
 
-    cnxn = pyodbc.connect(AZURE_DB_CONNECTION_STRING)
-    cursor = cnxn.cursor()
-
     statement = f"DELETE FROM [{table}] WHERE [{key}] = '{value}'"
 
-    cursor.execute(statement)
-    cursor.commit()
-
-    cnxn.close()
+    with connection() as cnxn:
+        cursor = cnxn.cursor()
+        cursor.execute(statement)
+        cursor.commit()
 
 def execute(statement: str) -> None:
 
-    cnxn = pyodbc.connect(AZURE_DB_CONNECTION_STRING)
-    cursor = cnxn.cursor()
-
-    cursor.execute(statement)
-    cursor.commit()
+    with metrics.span('sql.execute', statement=statement.split(None, 1)[0].upper()) as span, connection() as cnxn:
+        cursor = cnxn.cursor()
+        cursor.execute(statement)
+        span.set(rowcount=cursor.rowcount)
+        cursor.commit()
 
-    cnxn.close()
+def _insert_statement(table: str, columns: Sequence[str]) -> str:
+    return f"INSERT INTO {table} ([{'], ['.join(columns)}]) VALUES ({', '.join('?' for _ in columns)})"
 
 def insert_many(table: str, columns: tuple, records: list[tuple]) -> None:
 
-    cnxn = pyodbc.connect(AZURE_DB_CONNECTION_STRING)
+    sql_statement = _insert_statement(table, columns)
+
+    with connection() as cnxn:
+        cursor = cnxn.cursor()
+        cursor.fast_executemany = True
+        cursor.executemany(sql_statement, records)
+        cursor.commit()
+
+def _insert_batch(cnxn, cursor, statement: str, batch: List[Sequence], table: str, skip_rejected: bool=True) -> int:
+    """
+        Inserts one batch with executemany and commits it. If the server rejects the batch (a value that
+        doesn't convert or is too long for its column), the batch is inserted row by row instead and the
+        rows that fail are logged and skipped, so one bad row doesn't stop the load. With skip_rejected=False
+        the error is raised instead. Returns the rows inserted.
+    """
+    try:
+        cursor.executemany(statement, batch)
+        cnxn.commit()
+        return len(batch)
+    except Exception as e:
+        cnxn.rollback()
+        if not skip_rejected:
+            raise
+        logging.error(f"Batch of {len(batch)} rows rejected by {table}, inserting them one at a time: {e}")
+
+    inserted = 0
+    for row in batch:
+        try:
+            cursor.execute(statement, row)
+            inserted += 1
+        except Exception as e:
+            logging.critical(e)
+            logging.critical(f"Skipped row for {table}: {row}")
+    cnxn.commit()
+    return inserted
+
+def bulk_insert(table: str, columns: Sequence[str], rows: Iterable[Sequence], batch_size: int=BULK_BATCH_SIZE) -> int:
+    """
+        Inserts rows from any iterable using parameterized fast_executemany batches over one connection.
+        Each batch is committed on its own; rows the server rejects are logged and skipped (see
+        _insert_batch). Returns the number of rows inserted.
+    """
+    statement = _insert_statement(table, columns)
+    rows = iter(rows)
+    total = 0
+    start = monotonic()
+
+    with metrics.span('sql.bulk_insert', table=table) as span, connection() as cnxn:
+        cursor = cnxn.cursor()
+        cursor.fast_executemany = True
+
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            total += _insert_batch(cnxn, cursor, statement, batch, table)
+            span.add('batches')
+        span.set(rows=total)
+
+    elapsed = monotonic() - start
+    logging.info(f"Inserted {total} rows into {table} in {elapsed:.1f}s ({total / elapsed if elapsed else 0:,.0f} rows/s)")
+    return total
+
+@contextmanager
+def _staging_table(cnxn, staging: str, table: str, columns: Sequence[str]):
+    """
+        Creates an empty staging table with the given columns of table on the connection's session and
+        yields a cursor on it. When the block ends, anything not committed is rolled back and the staging
+        table is dropped.
+    """
+    column_list = ', '.join(f"[{column}]" for column in columns)
     cursor = cnxn.cursor()
+    # the staging table lives on the pooled session, so clear out any left by an earlier call
+    cursor.execute(f"DROP TABLE IF EXISTS {staging}")
+    cursor.execute(f"SELECT TOP 0 {column_list} INTO {staging} FROM {table}")
+    cnxn.commit()
+    try:
+        yield cursor
+    finally:
+        cnxn.rollback()
+        cursor.execute(f"DROP TABLE IF EXISTS {staging}")
+        cnxn.commit()
+
+def bulk_upsert(table: str, key: Sequence[str], columns: Sequence[str], rows: Iterable[Sequence],
+                batch_size: int=BULK_BATCH_SIZE) -> Tuple[int, int]:
+    """
+        Inserts or updates rows matched on the key columns. Each batch is loaded into a temporary
+        staging table with fast_executemany and applied with a single MERGE, so the cost is one round
+        trip per batch instead of one per row. Rows whose values are unchanged are left alone.
+
+            Returns:
+                (inserted, updated) row counts
+    """
+    staging = "#staging"
+    key_positions = [columns.index(column) for column in key]
+    values = [column for column in columns if column not in key]
+
+    match = ' AND '.join(f"(target.[{column}] = source.[{column}] OR (target.[{column}] IS NULL AND source.[{column}] IS NULL))"
+                         for column in key)
+    when_matched = ''
+    if values:
+        when_matched = f"""
+WHEN MATCHED AND EXISTS (SELECT {', '.join(f"source.[{column}]" for column in values)}
+                         EXCEPT SELECT {', '.join(f"target.[{column}]" for column in values)}) THEN
+    UPDATE SET {', '.join(f"target.[{column}] = source.[{column}]" for column in values)}"""
+
+    merge_statement = f"""\
+SET NOCOUNT ON;
+DECLARE @actions TABLE ([action] nvarchar(10));
+MERGE {table} WITH (HOLDLOCK) AS target
+USING {staging} AS source
+ON {match}{when_matched}
+WHEN NOT MATCHED BY TARGET THEN
+    INSERT ([{'], ['.join(columns)}]) VALUES ({', '.join(f"source.[{column}]" for column in columns)})
+OUTPUT $action INTO @actions;
+SELECT COALESCE(SUM(CASE WHEN [action] = 'INSERT' THEN 1 ELSE 0 END), 0),
+       COALESCE(SUM(CASE WHEN [action] = 'UPDATE' THEN 1 ELSE 0 END), 0)
+FROM @actions;"""
+
+    rows = iter(rows)
+    inserted = updated = total = 0
+    start = monotonic()
+
+    with metrics.span('sql.bulk_upsert', table=table) as span, connection() as cnxn, \
+         _staging_table(cnxn, staging, table, columns) as cursor:
+        cursor.fast_executemany = True
+
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+
+            # MERGE fails if two source rows match the same target row, so keep the last row per key.
+            batch = list({tuple(row[i] for i in key_positions): row for row in batch}.values())
+
+            cursor.executemany(_insert_statement(staging, columns), batch)
+            cursor.execute(merge_statement)
+            batch_inserted, batch_updated = cursor.fetchone()
+            cursor.execute(f"TRUNCATE TABLE {staging}")
+            cnxn.commit()
+
+            inserted += batch_inserted
+            updated += batch_updated
+            total += len(batch)
+
+        span.set(rows=total, inserted=inserted, updated=updated)
+
+    elapsed = monotonic() - start
+    logging.info(f"Merged {total} rows into {table} in {elapsed:.1f}s: {inserted} inserted, {updated} updated")
+    return inserted, updated
+
+def bulk_replace(table: str, columns: Sequence[str], rows: Iterable[Sequence], where: str,
+                 batch_size: int=BULK_BATCH_SIZE) -> int:
+    """
+        Replaces the rows of a table matching a WHERE clause with the given rows. The rows are loaded
+        into a temporary staging table in fast_executemany batches first; the DELETE and the INSERT ...
+        SELECT from staging then run in one transaction once every row has arrived. If the rows stop
+        part way (a dropped download, a failing stage), the table is left as it was. Single rows the
+        server rejects are logged and skipped, as in bulk_insert.
+
+            Returns:
+                rows (int)  : The number of rows inserted
+    """
+    staging = "#replace"
+    column_list = ', '.join(f"[{column}]" for column in columns)
+    rows = iter(rows)
+    total = 0
+    start = monotonic()
+
+    with metrics.span('sql.bulk_replace', table=table) as span, connection() as cnxn, \
+         _staging_table(cnxn, staging, table, columns) as cursor:
+        cursor.fast_executemany = True
+
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            total += _insert_batch(cnxn, cursor, _insert_statement(staging, columns), batch, table)
+            span.add('batches')
+
+        cursor.execute(f"DELETE FROM {table} WHERE {where}")
+        span.set(deleted=cursor.rowcount)
+        cursor.execute(f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM {staging}")
+        cnxn.commit()
+
+        span.set(rows=total)
+
+    elapsed = monotonic() - start
+    logging.info(f"Replaced {table} rows where {where} with {total} rows in {elapsed:.1f}s")
+    return total
+
+def _frame_rows(df: pd.DataFrame) -> List[tuple]:
+    # pyodbc needs None rather than NaN / NaT / <NA> for NULLs, and plain Python values
+    return list(df.astype(object).where(df.notna(), None).itertuples(index=False, name=None))
+
+def _write_chunk(table: str, columns: List[str], chunk: pd.DataFrame, skip_rejected: bool) -> int:
+    with connection() as cnxn:
+        cursor = cnxn.cursor()
+        cursor.fast_executemany = True
+        return _insert_batch(cnxn, cursor, _insert_statement(table, columns), _frame_rows(chunk), table, skip_rejected)
+
+def _write_chunks(table: str, chunks: Iterable[pd.DataFrame], max_workers: int, skip_rejected: bool=True) -> int:
+    # Chunks are written from a pool of max_workers connections. At most two chunks per worker are
+    # taken from chunks ahead of the writes, so a generator of chunks isn't read faster than it is written.
+    total = 0
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for chunk in chunks:
+            if len(pending) >= 2 * max(1, max_workers):
+                total += pending.popleft().result()
+            pending.append(executor.submit(_write_chunk, table, list(chunk.columns), chunk, skip_rejected))
+        while pending:
+            total += pending.popleft().result()
+    return total
+
+def write_frame(df: pd.DataFrame, table: str, chunksize: int=BULK_BATCH_SIZE, max_workers: int=SQL_WRITE_WORKERS,
+                atomic: bool=False) -> int:
+    """
+        Appends a DataFrame to an existing table. The frame is split into chunks that are written with
+        fast_executemany from up to max_workers pooled connections at once.
 
-    cursor.fast_executemany = True
+        Chunks are committed independently, so a failure can leave part of the frame written, and rows the
+        server rejects are logged and skipped. With atomic=True the chunks are loaded into a global temporary
+        table instead and moved into the table by a single INSERT ... SELECT, so either every row lands or
+        none does; a rejected row fails the write.
 
-    sql_statement = f"INSERT INTO {table} ([{'], ['.join(columns)}]) VALUES ({'?, '.join(['' for _ in range(len(columns))]) + '?'})"
-    cursor.executemany(sql_statement, records)
-    cursor.commit()
+            Returns:
+                rows (int)  : The number of rows written
+    """
+    if df.empty:
+        return 0
+
+    chunks = [df.iloc[start:start + chunksize] for start in range(0, len(df), chunksize)]
+    workers = min(max_workers, len(chunks))
+
+    start = monotonic()
+    with metrics.span('sql.write_frame', table=table, atomic=atomic, chunks=len(chunks)) as span:
+        if atomic:
+            total = _write_atomic(df, table, chunks, workers)
+        else:
+            total = _write_chunks(table, chunks, workers)
+        span.set(rows=total)
+
+    elapsed = monotonic() - start
+    logging.info(f"Wrote {total} rows into {table} in {elapsed:.1f}s ({total / elapsed if elapsed else 0:,.0f} rows/s)")
+    return total
+
+def _write_atomic(df: pd.DataFrame, table: str, chunks: List[pd.DataFrame], max_workers: int) -> int:
+    # A ## table is visible to every connection in the pool, unlike a # table, but it is dropped when the
+    # session that created it ends. That session is kept checked out until the rows have been moved, so
+    # the pool can't close or recycle it under the chunk writers.
+    column_list = ', '.join(f"[{column}]" for column in df.columns)
+    target = f"##{table}_{uuid.uuid4().hex}"
+
+    with connection() as cnxn, _staging_table(cnxn, target, table, df.columns) as cursor:
+        total = _write_chunks(target, chunks, max_workers, skip_rejected=False)
+        cursor.execute(f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM {target}")
+        cnxn.commit()
+    return total
+
+def write_frames(frames: Iterable[pd.DataFrame], table: str, chunksize: int=BULK_BATCH_SIZE,
+                 max_workers: int=SQL_WRITE_WORKERS) -> int:
+    """
+        Appends a stream of DataFrames (e.g. the batches of a pipeline) to an existing table. Every frame
+        is split into chunks and the chunks of all frames share one pool of max_workers connections, so
+        small frames are still written in parallel. Chunks are committed independently.
 
-    cnxn.close()
+            Returns:
+                rows (int)  : The number of rows written
+    """
+    def chunks() -> Iterator[pd.DataFrame]:
+        for df in frames:
+            for start in range(0, len(df), chunksize):
+                yield df.iloc[start:start + chunksize]
 
-def update(table: str, key_column: str, key_value: str, record: List[tuple]) -> None:
+    start = monotonic()
+    with metrics.span('sql.write_frames', table=table) as span:
+        total = _write_chunks(table, chunks(), max_workers)
+        span.set(rows=total)
 
-    cnxn = pyodbc.connect(AZURE_DB_CONNECTION_STRING)
-    cursor = cnxn.cursor()
+    elapsed = monotonic() - start
+    logging.info(f"Wrote {total} rows into {table} in {elapsed:.1f}s ({total / elapsed if elapsed else 0:,.0f} rows/s)")
+    return total
+
+def update(table: str, key_column: str, key_value: str, record: List[tuple]) -> None:
 
     statement = f"""
 UPDATE {table}
@@ -108,10 +455,10 @@ SET {', '.join([f"[{column}] = '{value}'" for column, value in record])}
 WHERE [{key_column}] = '{key_value}'
     """
 
-    cursor.execute(statement)
-    cursor.commit()
-
-    cnxn.close()
+    with connection() as cnxn:
+        cursor = cnxn.cursor()
+        cursor.execute(statement)
+        cursor.commit()
 
 def clean_text(record: dict) -> dict:
     for key, value in record.items():
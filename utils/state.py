@@ -0,0 +1,49 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from contextlib import closing
+from typing import Any, Dict
+
+# Local SQLite file that keeps small pieces of state (last pushed pallets, alert cooldowns...) between
+# timer runs. It lives on the instance's local disk, so a new instance simply starts from empty state.
+STATE_DB_PATH = os.environ.get('STATE_DB_PATH') or os.path.join(tempfile.gettempdir(), 'accutec-functions-state.sqlite3')
+
+
+class StateStore():
+    """
+        JSON values by namespace and key in a SQLite file. Every call uses its own short-lived connection,
+        so a store can be shared between threads.
+    """
+    def __init__(self, path: str=STATE_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        with closing(self._connect()) as cnxn, cnxn:
+            cnxn.execute("CREATE TABLE IF NOT EXISTS state (namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                         "PRIMARY KEY (namespace, key))")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get(self, namespace: str, key: str, default: Any=None) -> Any:
+        with self._lock, closing(self._connect()) as cnxn:
+            row = cnxn.execute("SELECT value FROM state WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def get_all(self, namespace: str) -> Dict[str, Any]:
+        with self._lock, closing(self._connect()) as cnxn:
+            rows = cnxn.execute("SELECT key, value FROM state WHERE namespace = ?", (namespace,)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def put(self, namespace: str, values: Dict[str, Any]) -> None:
+        """
+            Writes several keys of a namespace in one transaction.
+        """
+        with self._lock, closing(self._connect()) as cnxn, cnxn:
+            cnxn.executemany("INSERT OR REPLACE INTO state (namespace, key, value) VALUES (?, ?, ?)",
+                             [(namespace, key, json.dumps(value, default=str)) for key, value in values.items()])
+
+    def delete(self, namespace: str, *keys: str) -> None:
+        with self._lock, closing(self._connect()) as cnxn, cnxn:
+            cnxn.executemany("DELETE FROM state WHERE namespace = ? AND key = ?", [(namespace, key) for key in keys])
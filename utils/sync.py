@@ -0,0 +1,91 @@
+import datetime
+import logging
+import os
+import threading
+from typing import NamedTuple
+from utils import sql
+
+# Table holding the high-watermark of each incrementally synced fact table.
+SYNC_STATE_TABLE = 'syncState'
+
+# How often the whole window is reloaded to pick up late corrections to older rows.
+FULL_SYNC_INTERVAL_DAYS = int(os.environ.get('FULL_SYNC_INTERVAL_DAYS', 7))
+
+# How far before the last watermark an incremental run starts, to catch rows that were
+# entered around the time of the last run.
+SYNC_OVERLAP = datetime.timedelta(hours=int(os.environ.get('SYNC_OVERLAP_HOURS', 24)))
+
+# Tables that may be synced incrementally, comma separated. The reports of the other tables filter on a
+# date their rows keep changing after (ship orders get shipped, jobs and clock-ins are still open, invoices
+# get paid...) and have no updated-at column to filter on instead, so they always reload the full window.
+INCREMENTAL_TABLES = [table.strip() for table in os.environ.get('INCREMENTAL_SYNC_TABLES', 'factReceipt').split(',') if table.strip()]
+
+_state_table_ready = False
+_state_table_lock = threading.Lock()
+
+
+class SyncWindow(NamedTuple):
+    from_threshold  : datetime.datetime
+    to_threshold    : datetime.datetime
+    started_at      : datetime.datetime
+    full            : bool
+
+
+def _naive(timestamp: datetime.datetime) -> datetime.datetime:
+    # Thresholds are local (US/Eastern) wall times, which is also how they are stored.
+    return timestamp.replace(tzinfo=None, second=0, microsecond=0)
+
+def ensure_state_table() -> None:
+    global _state_table_ready
+    with _state_table_lock:
+        if _state_table_ready:
+            return
+        sql.execute(f"""
+IF OBJECT_ID('{SYNC_STATE_TABLE}') IS NULL
+    CREATE TABLE {SYNC_STATE_TABLE} (
+        [Table name]        nvarchar(128) NOT NULL PRIMARY KEY,
+        [Watermark]         datetime2 NOT NULL,
+        [Last full sync]    datetime2 NOT NULL
+    )""")
+        _state_table_ready = True
+
+def get_sync_window(table: str, from_threshold: datetime.datetime, to_threshold: datetime.datetime,
+                    started_at: datetime.datetime) -> SyncWindow:
+    """
+        Returns the window a nightly job needs to reload for the table.
+
+        from_threshold/to_threshold is the full window the job covers. If the table is one of the
+        INCREMENTAL_TABLES, was synced successfully before and its last full reload is recent enough,
+        the window starts at the last watermark (less SYNC_OVERLAP) instead, so only recent rows are
+        requested and replaced.
+    """
+    ensure_state_table()
+
+    from_threshold, to_threshold, started_at = _naive(from_threshold), _naive(to_threshold), _naive(started_at)
+
+    state = sql.query(f"SELECT [Watermark], [Last full sync] FROM {SYNC_STATE_TABLE} WHERE [Table name] = '{table}'")
+
+    full = True
+    if state and table in INCREMENTAL_TABLES:
+        watermark, last_full_sync = state[0]
+        if watermark >= from_threshold and started_at - last_full_sync < datetime.timedelta(days=FULL_SYNC_INTERVAL_DAYS):
+            from_threshold = max(from_threshold, watermark - SYNC_OVERLAP)
+            full = False
+
+    logging.info(f"{table}: {'full' if full else 'incremental'} sync from {from_threshold} to {to_threshold}")
+    return SyncWindow(from_threshold, to_threshold, started_at, full)
+
+def mark_synced(table: str, window: SyncWindow) -> None:
+    """
+        Records a successful sync. Call it only once the window has been fully written.
+    """
+    last_full_sync = "source.[Watermark]" if window.full else "target.[Last full sync]"
+
+    sql.execute(f"""
+MERGE {SYNC_STATE_TABLE} AS target
+USING (SELECT '{table}' AS [Table name], CAST('{window.started_at:%Y-%m-%d %H:%M}' AS datetime2) AS [Watermark]) AS source
+ON target.[Table name] = source.[Table name]
+WHEN MATCHED THEN
+    UPDATE SET [Watermark] = source.[Watermark], [Last full sync] = {last_full_sync}
+WHEN NOT MATCHED THEN
+    INSERT ([Table name], [Watermark], [Last full sync]) VALUES (source.[Table name], source.[Watermark], source.[Watermark]);""")